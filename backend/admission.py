@@ -0,0 +1,136 @@
+"""
+Admission control for the endpoints that call paid upstream services.
+
+A per-client token bucket enforces the request rate, and a global
+concurrency cap with a short bounded wait queue keeps a burst from tying up
+every worker thread. Requests beyond either limit are refused immediately
+with a Retry-After hint instead of queueing without bound.
+"""
+import threading
+import time
+
+from caching import TTLCache
+
+
+class TokenBucketLimiter:
+    def __init__(self, requests, window, max_clients=10000):
+        """
+        Args:
+            requests (int): Requests a client may make per window; also the
+                burst size
+            window (float): Window length in seconds
+            max_clients (int): Number of client buckets kept in memory
+        """
+        self.capacity = requests
+        self.rate = requests / window
+        # Idle clients refill completely after one window, so their buckets
+        # can be forgotten after that
+        self._buckets = TTLCache(max_entries=max_clients, ttl=window)
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    def acquire(self, client_id, tokens=1):
+        """
+        Take tokens from a client's bucket, all or none.
+
+        Args:
+            client_id (str): Client the request is charged to
+            tokens (int): Tokens to take, e.g. one per item of a batch
+
+        Returns:
+            float: 0 if the request is allowed, otherwise seconds until
+            enough tokens are available
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(client_id)
+            if bucket is None:
+                available = self.capacity
+            else:
+                available, updated_at = bucket
+                available = min(self.capacity, available + (now - updated_at) * self.rate)
+            if available >= tokens:
+                self._buckets.set(client_id, (available - tokens, now))
+                self.allowed += 1
+                return 0
+            self._buckets.set(client_id, (available, now))
+            self.limited += 1
+            return (tokens - available) / self.rate
+
+    def stats(self):
+        return {
+            "capacity": self.capacity,
+            "rate_per_second": self.rate,
+            "clients": len(self._buckets),
+            "allowed": self.allowed,
+            "limited": self.limited,
+        }
+
+
+class ConcurrencyLimiter:
+    def __init__(self, max_concurrent, max_waiting=0, wait_timeout=0):
+        """
+        Args:
+            max_concurrent (int): Requests allowed to run at once
+            max_waiting (int): Requests allowed to wait for a slot; any more
+                are refused straight away
+            wait_timeout (float): Seconds a waiting request may wait for a slot
+        """
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self._condition = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self.peak = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def acquire(self, blocking=True):
+        """
+        Take a slot, waiting up to wait_timeout if the queue has room.
+
+        Args:
+            blocking (bool): Wait for a slot; False only takes a free one
+
+        Returns:
+            bool: True if a slot was taken; the caller must release() it
+        """
+        with self._condition:
+            if self._active >= self.max_concurrent:
+                if not blocking or self._waiting >= self.max_waiting:
+                    self.rejected += 1
+                    return False
+                self._waiting += 1
+                try:
+                    got_slot = self._condition.wait_for(
+                        lambda: self._active < self.max_concurrent, timeout=self.wait_timeout
+                    )
+                finally:
+                    self._waiting -= 1
+                if not got_slot:
+                    self.timed_out += 1
+                    return False
+            self._active += 1
+            self.peak = max(self.peak, self._active)
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    def stats(self):
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_waiting": self.max_waiting,
+            "active": self._active,
+            "waiting": self._waiting,
+            "peak": self.peak,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
@@ -0,0 +1,395 @@
+"""
+asyncio serving mode for the try-on API.
+
+Serves the same /api/analyze-user-image, /api/swap-head and /images routes as
+main.py, but OpenAI and HeadSwapper calls are awaited instead of holding a
+worker thread, so one process can keep hundreds of try-ons in flight.
+CPU-bound image work runs in the default thread pool.
+
+Run with:
+    hypercorn asgi:app --bind 0.0.0.0:5003
+"""
+import asyncio
+import copy
+import functools
+import logging
+import traceback
+from io import BytesIO
+
+import httpx
+from openai import AsyncOpenAI
+from quart import Quart, jsonify, request, send_file
+from quart.wrappers.request import Request as QuartRequest
+from quart_cors import cors
+
+import server_config
+from admission import ConcurrencyLimiter
+from caching import AsyncSingleFlight, content_hash
+from headswapper import AsyncHeadSwapperClient
+from metrics import Registry
+from openai_governor import GovernorTimeout, call_outcome, openai_governor
+from uploads import MAX_CONTENT_LENGTH, upload_stream_factory
+from main import (
+    CORS_ORIGINS,
+    HeadSwapperUnavailable,
+    RESPONSE_FORMATS,
+    RESULT_HEADERS,
+    TryOnError,
+    admit_request,
+    analysis_busy_error,
+    apply_skin_tone_estimate,
+    api_key,
+    build_analysis_params,
+    build_headswap_payload,
+    client_id,
+    configure_logging,
+    deliver_swap_result,
+    fallback_result,
+    get_cached_analysis,
+    headswap_cache,
+    headswap_cache_key,
+    headswap_parameters,
+    headswapper_breaker,
+    headswapper_health,
+    headswapper_hedger,
+    lookup_cached_analysis,
+    metrics_registry,
+    parse_analysis_response,
+    parse_headswap_response,
+    read_upload,
+    record_headswapper_error,
+    reference_images,
+    register_upload,
+    requests_in_flight,
+    resolve_image_request,
+    resolve_reference_image,
+    resolve_upload,
+    stage_seconds,
+    store_analysis,
+    stored_result_response,
+    upstream_errors_total,
+    warm_caches,
+)
+
+class AsyncUploadRequest(QuartRequest):
+    """
+    Quart request that keeps file uploads in an UploadStream.
+    """
+
+    def make_form_data_parser(self):
+        return self.form_data_parser_class(
+            max_content_length=self.max_content_length,
+            max_form_memory_size=self.max_form_memory_size,
+            max_form_parts=self.max_form_parts,
+            cls=self.parameter_storage_class,
+            stream_factory=upload_stream_factory,
+        )
+
+
+app = Quart(__name__)
+app.request_class = AsyncUploadRequest
+app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
+app = cors(
+    app,
+    allow_origin=CORS_ORIGINS,
+    allow_credentials=True,
+    allow_headers=["Content-Type"],
+    expose_headers=RESULT_HEADERS,
+    allow_methods=["GET", "POST", "OPTIONS"],
+)
+
+# Created on startup so they bind to the serving event loop
+async_client = None
+async_headswapper = None
+
+
+@app.before_serving
+async def open_clients():
+    global async_client, async_headswapper
+    configure_logging()
+    warm_caches()
+    headswapper_health.start()
+    async_client = AsyncOpenAI(api_key=api_key, max_retries=0)
+    async_headswapper = AsyncHeadSwapperClient(
+        server_config.HEADSWAPPER_URL,
+        pool_size=server_config.HEADSWAPPER_POOL_SIZE,
+        connect_timeout=server_config.HEADSWAPPER_CONNECT_TIMEOUT,
+        read_timeout=server_config.HEADSWAPPER_READ_TIMEOUT,
+        max_retries=server_config.HEADSWAPPER_MAX_RETRIES,
+    )
+
+
+@app.after_serving
+async def close_clients():
+    await async_headswapper.aclose()
+    await async_client.close()
+
+
+# Waiting requests cost no threads here, so the cap is much higher than
+# main.concurrency_limiter's
+concurrency_limiter = ConcurrencyLimiter(server_config.ASGI_MAX_CONCURRENT)
+
+
+def admission_controlled(view):
+    """
+    Async version of main.admission_controlled. Requests never wait for a
+    slot here, since waiting would block the event loop.
+    """
+
+    @functools.wraps(view)
+    async def wrapper(*args, **kwargs):
+        refusal = admit_request(client_id(request), blocking=False, limiter=concurrency_limiter)
+        if refusal is not None:
+            return refusal
+        try:
+            return await view(*args, **kwargs)
+        finally:
+            concurrency_limiter.release()
+
+    return wrapper
+
+
+async def analyze_user_image_async(image_bytes, image_hash=None):
+    """
+    Async version of main.analyze_user_image_from_bytes sharing its cache.
+    """
+    image_hash = image_hash or await asyncio.to_thread(content_hash, image_bytes)
+    cached, fingerprint = await asyncio.to_thread(lookup_cached_analysis, image_bytes, image_hash)
+    if cached is not None:
+        return cached
+
+    result, shared = await analysis_flights.do(
+        image_hash, analyze_and_store_async, image_bytes, image_hash, fingerprint
+    )
+    if shared:
+        logging.debug(f"DEBUG: Joined in-flight analysis for {image_hash[:12]}")
+        return copy.deepcopy(result)
+    return result
+
+
+# Concurrent analyses of the same upload share one OpenAI call
+analysis_flights = AsyncSingleFlight()
+
+
+async def analyze_and_store_async(image_bytes, image_hash, fingerprint):
+    """
+    Async version of main._analyze_and_store.
+    """
+    cached = await asyncio.to_thread(get_cached_analysis, image_hash)
+    if cached is not None:
+        return cached
+
+    params = await asyncio.to_thread(build_analysis_params, image_bytes)
+    try:
+        with stage_seconds.time(stage="gpt4o"):
+            response = await openai_governor.acall(
+                "chat",
+                async_client.chat.completions.create,
+                timeout=server_config.OPENAI_ACQUIRE_TIMEOUT,
+                **params,
+            )
+    except GovernorTimeout:
+        raise analysis_busy_error()
+    except Exception as e:
+        upstream_errors_total.inc(upstream="openai")
+        logging.debug(f"DEBUG: Error in OpenAI API call: {e}")
+        if call_outcome(e)[0] == "throttled":
+            raise analysis_busy_error()
+        raise
+    result = await asyncio.to_thread(
+        apply_skin_tone_estimate, parse_analysis_response(response), image_bytes
+    )
+    store_analysis(image_hash, fingerprint, result)
+    return result
+
+
+async def call_headswapper_async(payload):
+    """
+    Async version of main.call_headswapper.
+    """
+    try:
+        with stage_seconds.time(stage="headswapper"):
+            hs_response = await headswapper_hedger.acall(async_headswapper.swap, payload)
+        logging.debug(f"HeadSwapper response status: {hs_response.status_code}")
+        hs_response.raise_for_status()
+        response_data = hs_response.json()
+    except httpx.HTTPError as e:
+        logging.error(f"HeadSwapper API error: {str(e)}")
+        status_code = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+        record_headswapper_error(status_code)
+        raise HeadSwapperUnavailable()
+    except Exception as e:
+        logging.error(f"Error processing HeadSwapper response: {str(e)}")
+        raise TryOnError("Failed to process HeadSwapper response", 500)
+
+    output_image = parse_headswap_response(response_data)
+    headswapper_breaker.record_success()
+    return output_image
+
+
+# Identical concurrent try-ons share one HeadSwapper call, as in main.iter_tryon
+headswap_flights = AsyncSingleFlight()
+
+
+async def swap_head_async(cache_key, image_bytes, analysis, reference_image_data_uri):
+    """
+    Async version of main.swap_head.
+    """
+    payload = await asyncio.to_thread(
+        build_headswap_payload, image_bytes, analysis, reference_image_data_uri
+    )
+    output_image = await call_headswapper_async(payload)
+    headswap_cache.set(cache_key, output_image)
+    return output_image
+
+
+@app.before_request
+async def track_request_start():
+    requests_in_flight.inc(endpoint=request.endpoint or "unknown")
+
+
+@app.teardown_request
+async def track_request_end(exc):
+    requests_in_flight.dec(endpoint=request.endpoint or "unknown")
+
+
+@app.route("/metrics")
+async def metrics_api():
+    return metrics_registry.render(), 200, {"Content-Type": Registry.CONTENT_TYPE}
+
+
+@app.errorhandler(413)
+async def request_entity_too_large(e):
+    return jsonify({"error": "File too large. Maximum size is 10MB."}), 413
+
+
+@app.route("/")
+async def health_check():
+    return jsonify({"status": "ok", "message": "Server is running"}), 200
+
+
+@app.route("/api/analyze-user-image", methods=["POST"])
+@admission_controlled
+async def analyze_user_image_api():
+    files = await request.files
+    if "image" not in files:
+        return jsonify({"error": "No image file provided"}), 400
+
+    try:
+        file_content, image_hash = read_upload(files["image"])
+    except TryOnError as e:
+        return jsonify({"error": e.message}), e.status_code, e.headers
+
+    try:
+        result = await analyze_user_image_async(file_content, image_hash)
+        return jsonify(await asyncio.to_thread(register_upload, file_content, result, image_hash))
+    except TryOnError as e:
+        return jsonify({"error": e.message}), e.status_code, e.headers
+    except Exception as e:
+        logging.error(f"Error in analyze_user_image_api: {e}")
+        logging.error(f"Full traceback: {traceback.format_exc()}")
+        return jsonify({"error": "Internal server error. Please try again."}), 500
+
+
+@app.route("/api/swap-head", methods=["POST"])
+@admission_controlled
+async def swap_head_api():
+    form = await request.form
+    files = await request.files
+    response_format = form.get("response_format", "json")
+    if response_format not in RESPONSE_FORMATS:
+        return jsonify({"error": f"response_format must be one of: {', '.join(RESPONSE_FORMATS)}"}), 400
+
+    try:
+        original_image_bytes, image_hash, analysis = resolve_upload(
+            form.get("upload_id"), files.get("image")
+        )
+        if analysis is None:
+            analysis = await analyze_user_image_async(original_image_bytes, image_hash)
+
+        ref_path, pregenerated_image_url = resolve_reference_image(
+            form.get("reference_image"), analysis
+        )
+        with stage_seconds.time(stage="reference_load"):
+            reference_image_data_uri, reference_hash = await asyncio.to_thread(
+                reference_images.load, ref_path
+            )
+
+        cache_key = headswap_cache_key(image_hash, reference_hash, headswap_parameters(analysis))
+        output_image = headswap_cache.get(cache_key)
+        if output_image is None:
+            if not headswapper_breaker.allow_request():
+                logging.warning("WARNING: HeadSwapper circuit breaker is open. Using fallback mode.")
+                return deliver_swap_result(
+                    fallback_result(reference_image_data_uri, analysis, pregenerated_image_url),
+                    response_format,
+                )
+            try:
+                output_image, _ = await headswap_flights.do(
+                    cache_key,
+                    swap_head_async,
+                    cache_key,
+                    original_image_bytes,
+                    analysis,
+                    reference_image_data_uri,
+                )
+            except HeadSwapperUnavailable:
+                logging.warning("WARNING: HeadSwapper request failed. Using fallback mode.")
+                return deliver_swap_result(
+                    fallback_result(reference_image_data_uri, analysis, pregenerated_image_url),
+                    response_format,
+                )
+
+        return await asyncio.to_thread(
+            deliver_swap_result,
+            {
+                "output_image": output_image,
+                "analysis": analysis,
+                "pregenerated_image_url": pregenerated_image_url,
+            },
+            response_format,
+        )
+    except TryOnError as e:
+        return jsonify({"error": e.message}), e.status_code, e.headers
+    except Exception as e:
+        logging.error(f"Error in swap-head: {e}")
+        traceback.print_exc()
+        return jsonify({"error": "Internal server error. Please try again."}), 500
+
+
+@app.route("/results/<result_id>")
+async def serve_result(result_id):
+    return stored_result_response(result_id, request.headers.get("If-None-Match"))
+
+
+@app.route("/images/<path:filename>")
+async def serve_images(filename):
+    try:
+        image = await asyncio.to_thread(
+            resolve_image_request, filename, request.args, request.accept_mimetypes
+        )
+        if image is None:
+            return jsonify({"error": "Image not found"}), 404
+        if image["etag"] in request.if_none_match:
+            response = await app.make_response(("", 304))
+        else:
+            response = await send_file(
+                image["path"] or BytesIO(image["data"]),
+                mimetype=image["mimetype"],
+                add_etags=False,
+                conditional=True,
+            )
+            response.last_modified = image["mtime"]
+        response.set_etag(image["etag"])
+        response.cache_control.public = True
+        response.cache_control.max_age = image["max_age"]
+        if image["immutable"]:
+            response.cache_control.immutable = True
+        if image["vary_accept"]:
+            response.vary.add("Accept")
+        return response
+    except TryOnError as e:
+        return jsonify({"error": e.message}), e.status_code, e.headers
+    except Exception as e:
+        logging.error(f"Error serving image {filename}: {e}")
+        return jsonify({"error": "Image not found"}), 404
@@ -0,0 +1,393 @@
+"""
+Caching primitives shared by the try-on API.
+"""
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+def content_hash(data):
+    """
+    Hash raw bytes for use as a cache key.
+
+    Args:
+        data (bytes): Content to hash
+
+    Returns:
+        str: Hex encoded SHA-256 digest
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+class TTLCache:
+    """
+    Thread-safe in-memory LRU cache with a size bound and per-entry TTL.
+    """
+
+    def __init__(self, max_entries=256, ttl=None, max_bytes=None, size=len):
+        """
+        Args:
+            max_entries (int): Maximum number of entries kept before the least
+                recently used one is evicted
+            ttl (float, optional): Seconds an entry stays valid, None for no expiry
+            max_bytes (int, optional): Total size of the values kept before the
+                least recently used ones are evicted, None for no limit
+            size (callable): Size of a value, used with max_bytes
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._size = size if max_bytes is not None else (lambda value: 0)
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at, size = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                self._total_bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        size = self._size(value)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._total_bytes -= previous[2]
+            self._entries[key] = (value, expires_at, size)
+            self._total_bytes += size
+            while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None
+                and self._total_bytes > self.max_bytes
+                and len(self._entries) > 1
+            ):
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= evicted[2]
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._total_bytes -= entry[2]
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        stats = {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+        if self.max_bytes is not None:
+            stats.update(bytes=self._total_bytes, max_bytes=self.max_bytes)
+        return stats
+
+
+class DiskCache:
+    """
+    File-per-entry byte cache. Entries expire based on their modification time.
+
+    With max_bytes set, the least recently used files are deleted once the
+    total size of the cache exceeds the limit.
+    """
+
+    def __init__(self, directory, ttl=None, suffix=".bin", max_bytes=None):
+        """
+        Args:
+            directory (str): Directory holding the cache files, created if missing
+            ttl (float, optional): Seconds an entry stays valid, None for no expiry
+            suffix (str): File extension used for cache entries
+            max_bytes (int, optional): Size limit of the directory, None for no limit
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.suffix = suffix
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # Path to size, least recently used first; only tracked with max_bytes
+        self._sizes = OrderedDict()
+        self._total_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        if max_bytes is not None:
+            self._scan()
+
+    def _scan(self):
+        files = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith(self.suffix) or filename.endswith(".tmp"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(files):
+            self._sizes[path] = size
+            self._total_bytes += size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + self.suffix)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+                self._remove(path)
+                self.misses += 1
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+        if self.max_bytes is not None:
+            with self._lock:
+                if path in self._sizes:
+                    self._sizes.move_to_end(path)
+        self.hits += 1
+        return data
+
+    def set(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temp file first so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if self.max_bytes is not None:
+            with self._lock:
+                self._total_bytes += len(data) - self._sizes.pop(path, 0)
+                self._sizes[path] = len(data)
+            self._evict()
+
+    def _remove(self, path):
+        os.remove(path)
+        with self._lock:
+            self._total_bytes -= self._sizes.pop(path, 0)
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._total_bytes <= self.max_bytes or len(self._sizes) <= 1:
+                    return
+                path, size = self._sizes.popitem(last=False)
+                self._total_bytes -= size
+                self.evictions += 1
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        stats = {"directory": self.directory, "hits": self.hits, "misses": self.misses}
+        if self.max_bytes is not None:
+            stats.update(
+                bytes=self._total_bytes, max_bytes=self.max_bytes, evictions=self.evictions
+            )
+        return stats
+
+
+class TieredCache:
+    """
+    In-memory LRU tier backed by an optional on-disk tier.
+
+    Values promoted from disk are decoded once and kept in memory afterwards.
+    """
+
+    def __init__(self, memory, disk=None, encode=None, decode=None):
+        """
+        Args:
+            memory (TTLCache): In-memory tier
+            disk (DiskCache, optional): On-disk tier
+            encode (callable, optional): Converts a value to bytes for the disk tier
+            decode (callable, optional): Converts bytes from the disk tier to a value
+        """
+        self.memory = memory
+        self.disk = disk
+        self._encode = encode or (lambda value: value)
+        self._decode = decode or (lambda data: data)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            data = self.disk.get(key)
+            if data is not None:
+                try:
+                    value = self._decode(data)
+                except ValueError:
+                    value = None
+                if value is not None:
+                    self.memory.set(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            try:
+                self.disk.set(key, self._encode(value))
+            except OSError:
+                # The disk tier is best effort; the memory tier still holds the value
+                pass
+
+    def stats(self):
+        stats = {"hits": self.hits, "misses": self.misses, "memory": self.memory.stats()}
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        return stats
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one execution.
+
+    The first caller for a key runs the function; callers that arrive while it
+    is running wait for it and receive the same result or exception.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.collapsed = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) unless a call for key is already in flight.
+
+        Returns:
+            tuple: (result, shared), where shared is True if the result came
+            from another caller's execution
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+                self.leaders += 1
+                leader = True
+            else:
+                self.collapsed += 1
+                leader = False
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"], True
+
+        try:
+            call["result"] = fn(*args, **kwargs)
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+        return call["result"], False
+
+    def stats(self):
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "collapsed": self.collapsed,
+        }
+
+
+class AsyncSingleFlight:
+    """
+    asyncio version of SingleFlight for coroutine functions.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.leaders = 0
+        self.collapsed = 0
+
+    async def do(self, key, fn, *args, **kwargs):
+        """
+        Await fn(*args, **kwargs) unless a call for key is already in flight.
+
+        Returns:
+            tuple: (result, shared), as SingleFlight.do()
+        """
+        future = self._calls.get(key)
+        if future is not None:
+            self.collapsed += 1
+            # Shielded so a disconnecting follower does not cancel the leader's call
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        self.leaders += 1
+        try:
+            result = await fn(*args, **kwargs)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Followers may not exist; avoid the "never retrieved" warning
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self._calls[key]
+        return result, False
+
+    def stats(self):
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "collapsed": self.collapsed,
+        }
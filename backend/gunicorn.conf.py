@@ -0,0 +1,72 @@
+"""
+gunicorn settings for the try-on API.
+
+Run from the backend directory with:
+    gunicorn
+
+Upload sessions, stored results and try-on jobs live in the worker process
+and have no shared-storage option. A follow-up request (/results/<id>, job
+polling, reusing an upload_id) that lands on another worker gets a 404/410,
+so the server runs a single worker. Requests spend most of their time
+waiting on OpenAI and the HeadSwapper, so that worker runs a pool of threads
+instead of one request at a time; to use more cores, run several instances
+behind a proxy that pins each client to one of them.
+
+Setting GUNICORN_WORKERS or WEB_CONCURRENCY above 1 breaks upload handles,
+job ids and result ids, and on_starting() refuses it unless
+GUNICORN_STICKY_SESSIONS=true declares that a proxy pins each client to one
+worker. Only then does preloading matter: the reference image cache and the
+static file index are built once in the master and shared copy-on-write.
+"""
+import gc
+import os
+
+import server_config
+
+wsgi_app = "main:create_app(start_services=False)"
+
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '5003')}")
+workers = int(os.getenv("GUNICORN_WORKERS", os.getenv("WEB_CONCURRENCY", 1)))
+sticky_sessions = os.getenv("GUNICORN_STICKY_SESSIONS", "false").lower() == "true"
+# gthread workers keep threads parked on upstream I/O cheaply; gevent can be
+# selected with GUNICORN_WORKER_CLASS when it is installed
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+# Also sizes the admission control defaults, see server_config.py
+threads = server_config.GUNICORN_THREADS
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+# A try-on can legitimately wait for the full HeadSwapper read timeout
+timeout = int(server_config.HEADSWAPPER_READ_TIMEOUT) + 30
+graceful_timeout = 30
+keepalive = 5
+# Heartbeat files in memory rather than on a possibly slow disk
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# Recycle workers periodically; cheap because the caches come from the master
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 0))
+
+accesslog = "-"
+loglevel = server_config.LOG_LEVEL.lower()
+
+
+def on_starting(server):
+    if server.cfg.workers > 1 and not sticky_sessions:
+        raise RuntimeError(
+            f"{server.cfg.workers} workers requested, but upload sessions, results and "
+            "try-on jobs are stored per process; run one worker, or set "
+            "GUNICORN_STICKY_SESSIONS=true behind a proxy that pins each client to a worker"
+        )
+
+
+def pre_fork(server, worker):
+    # Move everything built during preload out of the collector's reach so
+    # garbage collection in the workers does not touch (and copy) those pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Background threads do not survive fork(), start them in each worker
+    import main
+
+    main.start_background_services()
@@ -0,0 +1,545 @@
+"""
+HeadSwapper service integration: pooled HTTP client, circuit breaker,
+background health monitor and request hedging.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HeadSwapperClient:
+    """
+    Shared keep-alive HTTP client for the HeadSwapper service.
+
+    All calls go through one connection pool, so concurrent try-ons reuse
+    established TCP connections instead of opening a new one per request.
+    """
+
+    def __init__(
+        self,
+        url,
+        pool_size=10,
+        connect_timeout=5,
+        read_timeout=120,
+        max_retries=2,
+        backoff_factor=0.5,
+        pool_block=True,
+    ):
+        """
+        Args:
+            url (str): HeadSwapper endpoint
+            pool_size (int): Maximum number of pooled connections to the host
+            connect_timeout (float): Seconds allowed to establish a connection
+            read_timeout (float): Seconds allowed between bytes of the response
+            max_retries (int): Retry budget per call. Connection failures are
+                retried for every method, read failures and 502/503/504
+                responses only for idempotent methods
+            backoff_factor (float): Exponential backoff factor between retries
+            pool_block (bool): Wait for a free pooled connection instead of
+                opening extra short-lived ones when the pool is exhausted
+        """
+        self.url = url
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=max_retries,
+            status=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"GET", "HEAD", "OPTIONS"}),
+            raise_on_status=False,
+        )
+        self._adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=retry,
+            pool_block=pool_block,
+        )
+        self._session = requests.Session()
+        self._session.mount("http://", self._adapter)
+        self._session.mount("https://", self._adapter)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        self.requests = 0
+        self.failures = 0
+
+    def _request(self, method, timeout=None, **kwargs):
+        with self._lock:
+            self._in_flight += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+            self.requests += 1
+        try:
+            return self._session.request(
+                method, self.url, timeout=timeout or self.timeout, **kwargs
+            )
+        except requests.exceptions.RequestException:
+            with self._lock:
+                self.failures += 1
+            raise
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def swap(self, payload):
+        """
+        POST a head swap request.
+
+        Args:
+            payload (dict): JSON body for the HeadSwapper API
+
+        Returns:
+            requests.Response: Raw HeadSwapper response
+        """
+        return self._request("POST", json=payload)
+
+    def probe(self, timeout=5):
+        """
+        Cheap liveness check used by the health monitor.
+
+        Returns:
+            bool: True if the service answered without a server error
+        """
+        response = self._request("GET", timeout=(timeout, timeout))
+        # Any HTTP answer below 500 means the service is up and routing requests
+        return response.status_code < 500
+
+    def stats(self):
+        connections = 0
+        pooled_requests = 0
+        for key in self._adapter.poolmanager.pools.keys():
+            pool = self._adapter.poolmanager.pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                pooled_requests += pool.num_requests
+        return {
+            "pool_size": self.pool_size,
+            "in_flight": self._in_flight,
+            "peak_in_flight": self._peak_in_flight,
+            "utilization": self._in_flight / self.pool_size if self.pool_size else 0,
+            "connections_opened": connections,
+            "requests": self.requests,
+            "pooled_requests": pooled_requests,
+            "failures": self.failures,
+        }
+
+    def close(self):
+        self._session.close()
+
+
+class AsyncHeadSwapperClient:
+    """
+    asyncio counterpart of HeadSwapperClient for the ASGI app, built on httpx.
+
+    Only connection failures are retried, since the swap call is not idempotent.
+    """
+
+    def __init__(self, url, pool_size=10, connect_timeout=5, read_timeout=120, max_retries=2):
+        self.url = url
+        self.pool_size = pool_size
+        self._client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(
+                retries=max_retries,
+                limits=httpx.Limits(
+                    max_connections=pool_size, max_keepalive_connections=pool_size
+                ),
+            ),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout, pool=None),
+        )
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        self.requests = 0
+        self.failures = 0
+
+    async def swap(self, payload):
+        """
+        POST a head swap request.
+
+        Returns:
+            httpx.Response: Raw HeadSwapper response
+        """
+        # Counters are only touched from the event loop thread, so no lock
+        self._in_flight += 1
+        self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+        self.requests += 1
+        try:
+            return await self._client.post(self.url, json=payload)
+        except httpx.HTTPError:
+            self.failures += 1
+            raise
+        finally:
+            self._in_flight -= 1
+
+    def stats(self):
+        return {
+            "pool_size": self.pool_size,
+            "in_flight": self._in_flight,
+            "peak_in_flight": self._peak_in_flight,
+            "utilization": self._in_flight / self.pool_size if self.pool_size else 0,
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+class CircuitBreaker:
+    """
+    Tracks HeadSwapper failures and decides, in O(1), whether a call may be made.
+
+    closed: calls go through; consecutive failures past the threshold open it.
+    open: calls are refused until reset_timeout has passed.
+    half_open: one trial call is let through; its outcome closes or reopens it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=3, reset_timeout=30):
+        """
+        Args:
+            failure_threshold (int): Consecutive failures that open the breaker
+            reset_timeout (float): Seconds the breaker stays open before a trial call
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_started_at = None
+        self.times_opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        return self._state
+
+    def allow_request(self):
+        """
+        Returns:
+            bool: True if a HeadSwapper call may be attempted now
+        """
+        if self._state == self.CLOSED:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if self._state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                self._trial_started_at = None
+            if self._state == self.HALF_OPEN:
+                # Let a single trial through; retry if it never reported back
+                if (
+                    self._trial_started_at is None
+                    or now - self._trial_started_at >= self.reset_timeout
+                ):
+                    self._trial_started_at = now
+                    return True
+            if self._state == self.CLOSED:
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logging.info("HeadSwapper circuit breaker closed")
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or (
+                self._state == self.CLOSED and self._failures >= self.failure_threshold
+            ):
+                self._open()
+
+    def record_probe_success(self):
+        """
+        A passing health probe clears the failure count of a closed breaker
+        and lets an open breaker try real traffic early.
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                self._failures = 0
+            elif self._state == self.OPEN:
+                self._state = self.HALF_OPEN
+                self._trial_started_at = None
+
+    def _open(self):
+        if self._state != self.OPEN:
+            logging.warning("HeadSwapper circuit breaker opened")
+            self.times_opened += 1
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._trial_started_at = None
+
+    def stats(self):
+        return {
+            "state": self._state,
+            "consecutive_failures": self._failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+        }
+
+
+class HealthMonitor:
+    """
+    Probes the HeadSwapper on an interval from a daemon thread and feeds the
+    results into a circuit breaker, so requests never wait on a probe.
+    """
+
+    def __init__(self, client, breaker, interval=15, timeout=5):
+        """
+        Args:
+            client (HeadSwapperClient): Client used to probe the service
+            breaker (CircuitBreaker): Breaker updated with probe results
+            interval (float): Seconds between probes
+            timeout (float): Probe request timeout in seconds
+        """
+        self.client = client
+        self.breaker = breaker
+        self.interval = interval
+        self.timeout = timeout
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_probe_at = None
+        self.last_probe_ok = None
+
+    def check(self):
+        try:
+            healthy = self.client.probe(timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            logging.debug(f"DEBUG: HeadSwapper health probe failed: {e}")
+            healthy = False
+        self.last_probe_at = time.time()
+        self.last_probe_ok = healthy
+        if healthy:
+            self.breaker.record_probe_success()
+        else:
+            self.breaker.record_failure()
+        return healthy
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.check()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self.interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="headswapper-health", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {
+            "url": self.client.url,
+            "interval": self.interval,
+            "last_probe_at": self.last_probe_at,
+            "last_probe_ok": self.last_probe_ok,
+        }
+
+
+class RequestHedger:
+    """
+    Sends a duplicate HeadSwapper request when the first one is slower than
+    a percentile of recent latencies, and returns whichever succeeds first.
+
+    Hedges are paid for out of a budget that grows by budget_ratio per call,
+    so at most that fraction of extra load is added to the service.
+    """
+
+    def __init__(
+        self,
+        percentile=95,
+        budget_ratio=0.1,
+        min_samples=20,
+        min_delay=1.0,
+        max_burst=5,
+        window=200,
+        max_workers=40,
+        is_success=None,
+    ):
+        """
+        Args:
+            percentile (float): Latency percentile after which a hedge is
+                sent; 0 disables hedging
+            budget_ratio (float): Hedges allowed per call, e.g. 0.1 for 10%
+            min_samples (int): Latencies recorded before hedging starts
+            min_delay (float): Lower bound in seconds for the hedge delay
+            max_burst (int): Unused budget is capped at this many hedges
+            window (int): Number of recent latencies the percentile is taken from
+            max_workers (int): Threads available to run calls in sync mode
+            is_success (callable, optional): Decides whether a returned value
+                counts as a success; exceptions never do
+        """
+        self.percentile = percentile
+        self.budget_ratio = budget_ratio
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_burst = max_burst
+        self._is_success = is_success or (lambda result: True)
+        self._latencies = deque(maxlen=window)
+        self._executor = (
+            ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="headswapper-hedge")
+            if percentile > 0
+            else None
+        )
+        self._lock = threading.Lock()
+        self._budget = 0.0
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.budget_exhausted = 0
+
+    @property
+    def enabled(self):
+        return self.percentile > 0
+
+    def hedge_delay(self):
+        """
+        Returns:
+            float: Seconds to wait before hedging, None while too few
+            latencies have been recorded
+        """
+        latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return max(self.min_delay, latencies[index])
+
+    def _start_call(self):
+        """
+        Count a call and decide when (if at all) it may be hedged.
+        """
+        with self._lock:
+            self.calls += 1
+            self._budget = min(self._budget + self.budget_ratio, self.max_burst)
+        return self.hedge_delay()
+
+    def _take_hedge(self):
+        with self._lock:
+            if self._budget < 1:
+                self.budget_exhausted += 1
+                return False
+            self._budget -= 1
+            self.hedges += 1
+            return True
+
+    def _timed(self, fn, args):
+        start = time.perf_counter()
+        result = fn(*args)
+        if self._is_success(result):
+            self._latencies.append(time.perf_counter() - start)
+        return result
+
+    def call(self, fn, *args):
+        """
+        Run fn(*args), hedging it with a second call if it is slow.
+
+        Returns:
+            The first successful result, or the primary call's result if
+            neither succeeded
+
+        Raises:
+            Exception: The primary call's exception if neither call succeeded
+        """
+        if not self.enabled:
+            return fn(*args)
+        delay = self._start_call()
+        primary = self._executor.submit(self._timed, fn, args)
+        if delay is None:
+            return primary.result()
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._take_hedge():
+            return primary.result()
+
+        logging.info(f"HeadSwapper call exceeded {delay:.1f}s, sending hedged request")
+        hedge = self._executor.submit(self._timed, fn, args)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None and self._is_success(future.result()):
+                    # A running requests call cannot be interrupted; the loser
+                    # finishes in the background and its result is discarded
+                    for other in pending:
+                        other.cancel()
+                    if future is hedge:
+                        with self._lock:
+                            self.hedge_wins += 1
+                    return future.result()
+        return primary.result()
+
+    async def acall(self, fn, *args):
+        """
+        Async version of call() for coroutine functions; the losing call is
+        cancelled outright.
+        """
+        if not self.enabled:
+            return await fn(*args)
+
+        async def timed():
+            start = time.perf_counter()
+            result = await fn(*args)
+            if self._is_success(result):
+                self._latencies.append(time.perf_counter() - start)
+            return result
+
+        delay = self._start_call()
+        primary = asyncio.ensure_future(timed())
+        if delay is None:
+            return await primary
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not self._take_hedge():
+            return await primary
+
+        logging.info(f"HeadSwapper call exceeded {delay:.1f}s, sending hedged request")
+        hedge = asyncio.ensure_future(timed())
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and self._is_success(task.result()):
+                        if task is hedge:
+                            with self._lock:
+                                self.hedge_wins += 1
+                        return task.result()
+            return primary.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        delay = self.hedge_delay() if self.enabled else None
+        return {
+            "enabled": self.enabled,
+            "percentile": self.percentile,
+            "hedge_delay": round(delay, 3) if delay is not None else None,
+            "samples": len(self._latencies),
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "budget_exhausted": self.budget_exhausted,
+        }
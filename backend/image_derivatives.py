@@ -0,0 +1,137 @@
+"""
+Resized and re-encoded variants of the images served under /images.
+
+Requested widths are snapped to a fixed set of buckets so a handful of
+derivatives per image covers every layout. Derivatives are generated with
+Pillow on first request and kept in a size-bounded disk cache keyed by the
+content hash of the source image, so an edited source never serves a stale
+derivative.
+"""
+import logging
+import threading
+from io import BytesIO
+
+from PIL import Image
+
+from caching import SingleFlight
+
+try:
+    # Registers the AVIF codec with Pillow versions that do not bundle it
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+WIDTH_BUCKETS = (160, 320, 480, 640, 768, 1024, 1536)
+
+# Preferred order when the client does not ask for a format
+FORMATS = {
+    "avif": ("AVIF", "image/avif"),
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+
+
+def supported_formats():
+    """
+    Returns:
+        tuple: Keys of FORMATS that the installed Pillow can encode
+    """
+    registered = set(Image.registered_extensions().values())
+    return tuple(name for name, (pil_format, _) in FORMATS.items() if pil_format in registered)
+
+
+def snap_width(width):
+    """
+    Round a requested width up to the nearest bucket.
+
+    Returns:
+        int: Bucket width, the largest bucket for anything wider
+    """
+    for bucket in WIDTH_BUCKETS:
+        if width <= bucket:
+            return bucket
+    return WIDTH_BUCKETS[-1]
+
+
+def negotiate_format(accept, formats):
+    """
+    Pick the preferred format the client accepts.
+
+    Args:
+        accept (werkzeug.datastructures.MIMEAccept): Parsed Accept header
+        formats (tuple): Candidate format keys in order of preference
+
+    Returns:
+        str: A key of FORMATS; JPEG if the client accepts none of the others
+    """
+    for name in formats:
+        mime_type = FORMATS[name][1]
+        # Ignore */* so that browsers without AVIF/WebP support get JPEG
+        if any(value == mime_type and quality > 0 for value, quality in accept):
+            return name
+    return "jpeg"
+
+
+class DerivativeStore:
+    def __init__(self, cache, quality=80):
+        """
+        Args:
+            cache (DiskCache): Size-bounded cache holding encoded derivatives
+            quality (int): Encoder quality for all formats (1-100)
+        """
+        self.cache = cache
+        self.quality = quality
+        self.formats = supported_formats()
+        self._flights = SingleFlight()
+        self._lock = threading.Lock()
+        self.generated = 0
+
+    def get(self, source, width, image_format):
+        """
+        Get a derivative of an indexed static file, generating it if needed.
+
+        Args:
+            source (dict): Entry from StaticFileIndex.lookup
+            width (int): Bucket width; sources narrower than that are not upscaled
+            image_format (str): Key of FORMATS
+
+        Returns:
+            bytes: Encoded image
+        """
+        key = f"{source['etag']}-{width}.{image_format}"
+        data = self.cache.get(key)
+        if data is None:
+            # Concurrent first requests for one derivative encode it once
+            data, _ = self._flights.do(key, self._generate, key, source["path"], width, image_format)
+        return data
+
+    def _generate(self, key, path, width, image_format):
+        pil_format = FORMATS[image_format][0]
+        with Image.open(path) as img:
+            if img.width > width:
+                height = max(1, round(img.height * width / img.width))
+                img = img.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            if pil_format == "JPEG" and img.mode != "RGB":
+                img = img.convert("RGBA")
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                background.paste(img, mask=img.getchannel("A"))
+                img = background
+            elif img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA")
+            buffered = BytesIO()
+            img.save(buffered, format=pil_format, quality=self.quality)
+        data = buffered.getvalue()
+        try:
+            self.cache.set(key, data)
+        except OSError as e:
+            logging.warning(f"Could not cache image derivative {key}: {e}")
+        with self._lock:
+            self.generated += 1
+        return data
+
+    def stats(self):
+        return {
+            "formats": list(self.formats),
+            "generated": self.generated,
+            "cache": self.cache.stats(),
+        }
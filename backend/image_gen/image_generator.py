@@ -26,6 +26,8 @@ from io import BytesIO
 
 # Add the project root to the path to import config
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Process-wide OpenAI concurrency limits shared with the API server
+from openai_governor import openai_governor
 # config.py
 # Male body types import
 from image_gen.models import MALE_BODY_TYPES
@@ -90,7 +92,7 @@ class ImageGenerator:
         if api_key is None:
             api_key = DEFAULT_API_KEY
 
-        self.client = OpenAI(api_key=api_key)
+        self.client = OpenAI(api_key=api_key, max_retries=0)
         self.debug = debug
         self.image_quality = DEFAULT_IMAGE_QUALITY
         self.use_fabric_details = use_fabric_details
@@ -408,13 +410,10 @@ Add proper lighting and SHADOWS to the image to make it look realistic using the
                 f"⚠️ Rate limit exceeded during {operation_type}. Waiting and retrying..."
             )
 
-            # Check if the error response contains a specific retry-after time
-            if hasattr(error, "headers") and "retry-after" in error.headers:
-                retry_after = int(error.headers["retry-after"])
-                wait_time = max(wait_time, retry_after + 1)  # Add 1 second buffer
-            else:
-                # Apply exponential backoff for rate limit errors
-                wait_time = base_wait * (2**retry_count) + random.uniform(1, 5)
+            # The governor has already paused the image budget for every caller
+            # (honouring retry-after) and lowered its concurrency; retrying
+            # just queues behind that pause, so only add jitter here
+            wait_time = openai_governor.image.pause_remaining() + random.uniform(0, 1)
 
             if retry_count < max_retries:
                 print(
@@ -489,7 +488,8 @@ Add proper lighting and SHADOWS to the image to make it look realistic using the
                 # Log the prompt for debugging
                 self._log_prompt("IMAGE GENERATION PROMPT", prompt)
 
-                response = self.client.images.generate(
+                response = openai_governor.call(
+                    "image", self.client.images.generate,
                     model=IMAGE_MODEL,
                     prompt=prompt,
                     size=size,
@@ -668,7 +668,8 @@ Don't add any additional items like sunglasses, hats, etc."""
                             with open(fabric_detail_image, "rb") as fabric_file:
                                 images.append(fabric_file)
 
-                                transform_response = self.client.images.edit(
+                                transform_response = openai_governor.call(
+                                    "image", self.client.images.edit,
                                     model=IMAGE_MODEL,
                                     image=images,  # Pass both images as a list
                                     prompt=transform_prompt,
@@ -678,7 +679,8 @@ Don't add any additional items like sunglasses, hats, etc."""
                     else:
                         # Open reference image only and apply the transformation
                         with open(reference_image_path, "rb") as ref_file:
-                            transform_response = self.client.images.edit(
+                            transform_response = openai_governor.call(
+                                "image", self.client.images.edit,
                                 model=IMAGE_MODEL,
                                 image=ref_file,  # Single image doesn't need to be in a list
                                 prompt=transform_prompt,
@@ -998,7 +1000,8 @@ Add proper lighting and SHADOWS to the image to make it look realistic using the
     def _generate_image_with_prompt(self, prompt, output_file=None, size="1024x1024", quality="medium"):
         """Generate an image using the OpenAI API with the given prompt."""
         try:
-            response = self.client.images.generate(
+            response = openai_governor.call(
+                "image", self.client.images.generate,
                 model=IMAGE_MODEL,
                 prompt=prompt,
                 size=size,
@@ -1117,7 +1120,8 @@ FABRIC DETAILS (CRITICAL - REFER TO THIRD REFERENCE IMAGE):
                     reference_image_path, "rb"
                 ) as ref_file, open(fabric_detail_image, "rb") as fabric_file:
                     # Apply the transformation with all three images
-                    response = self.client.images.edit(
+                    response = openai_governor.call(
+                        "image", self.client.images.edit,
                         model=IMAGE_MODEL,
                         image=[
                             base_file,
@@ -1133,7 +1137,8 @@ FABRIC DETAILS (CRITICAL - REFER TO THIRD REFERENCE IMAGE):
                     reference_image_path, "rb"
                 ) as ref_file:
                     # Apply the transformation
-                    response = self.client.images.edit(
+                    response = openai_governor.call(
+                        "image", self.client.images.edit,
                         model=IMAGE_MODEL,
                         image=[base_file, ref_file],  # Pass both images as a list
                         prompt=prompt,
@@ -1273,7 +1278,8 @@ FABRIC DETAILS (CRITICAL - REFER TO THIRD REFERENCE IMAGE):
                         try:
                             # Generate the base body image
                             print("Generating base body image...")
-                            body_response = self.client.images.generate(
+                            body_response = openai_governor.call(
+                                "image", self.client.images.generate,
                                 model=IMAGE_MODEL,
                                 prompt=body_prompt,
                                 size=DEFAULT_IMAGE_SIZE,
@@ -93,7 +93,7 @@ class ImageGenerator:
         if api_key is None:
             api_key = DEFAULT_API_KEY
 
-        self.client = OpenAI(api_key=api_key)
+        self.client = OpenAI(api_key=api_key, max_retries=0)
         self.debug = debug
         self.image_quality = DEFAULT_IMAGE_QUALITY
         self.use_fabric_details = use_fabric_details
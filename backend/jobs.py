@@ -0,0 +1,163 @@
+"""
+Background try-on jobs.
+
+A bounded queue feeds a fixed pool of worker threads, so the web worker that
+accepts a try-on returns immediately and clients poll for the result.
+"""
+import json
+import logging
+import queue
+import secrets
+import threading
+import time
+
+from caching import TTLCache
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at capacity."""
+
+
+def _result_size(job):
+    # Results can carry inline base64 images; everything else is a few bytes
+    return len(json.dumps(job["result"])) if "result" in job else 0
+
+
+class JobQueue:
+    def __init__(
+        self, handler, workers=4, max_depth=32, ttl=600, error_handler=None, max_bytes=None
+    ):
+        """
+        Args:
+            handler (callable): Runs a job; called with the submitted arguments
+                and returns the job result
+            workers (int): Number of worker threads
+            max_depth (int): Jobs allowed to wait in the queue before submit()
+                refuses new ones
+            ttl (float): Seconds a job stays retrievable after its last update
+            error_handler (callable, optional): Maps an exception raised by the
+                handler to an (error message, HTTP status) tuple
+            max_bytes (int, optional): Total JSON size of the finished results
+                kept before the oldest jobs are dropped, None for no limit
+        """
+        self.handler = handler
+        self.workers = workers
+        self.max_depth = max_depth
+        self._error_handler = error_handler or (lambda e: (str(e), 500))
+        self._queue = queue.Queue(maxsize=max_depth)
+        # Queued and running jobs; bounded by max_depth + workers, never evicted
+        self._active = {}
+        # Finished jobs, evicted by age, count and result size
+        self._jobs = TTLCache(
+            max_entries=max(1024, max_depth * 8),
+            ttl=ttl,
+            max_bytes=max_bytes,
+            size=_result_size,
+        )
+        self._threads = []
+        self._lock = threading.Lock()
+        self._running = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.succeeded = 0
+        self.failed = 0
+
+    def start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._work, name=f"tryon-job-{len(self._threads)}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, *args, **kwargs):
+        """
+        Queue a job.
+
+        Returns:
+            str: Job id
+
+        Raises:
+            QueueFullError: If max_depth jobs are already waiting
+        """
+        job_id = secrets.token_urlsafe(16)
+        job = {"id": job_id, "status": QUEUED, "created_at": time.time()}
+        with self._lock:
+            self._active[job_id] = job
+        try:
+            self._queue.put_nowait((job_id, args, kwargs))
+        except queue.Full:
+            with self._lock:
+                del self._active[job_id]
+                self.rejected += 1
+            raise QueueFullError()
+        with self._lock:
+            self.submitted += 1
+        return job_id
+
+    def get(self, job_id):
+        """
+        Returns:
+            dict: Copy of the job record, or None if unknown or expired
+        """
+        with self._lock:
+            job = self._active.get(job_id)
+        if job is None:
+            job = self._jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self._active[job_id] = dict(self._active[job_id], **fields)
+
+    def _finish(self, job_id, **fields):
+        with self._lock:
+            job = dict(self._active.pop(job_id), **fields)
+        self._jobs.set(job_id, job)
+
+    def _work(self):
+        while True:
+            job_id, args, kwargs = self._queue.get()
+            with self._lock:
+                self._running += 1
+            self._update(job_id, status=RUNNING, started_at=time.time())
+            try:
+                result = self.handler(*args, **kwargs)
+            except Exception as e:
+                error, status_code = self._error_handler(e)
+                logging.error(f"Try-on job {job_id} failed: {e}")
+                self._finish(
+                    job_id,
+                    status=FAILED,
+                    error=error,
+                    status_code=status_code,
+                    finished_at=time.time(),
+                )
+                with self._lock:
+                    self.failed += 1
+            else:
+                self._finish(job_id, status=SUCCEEDED, result=result, finished_at=time.time())
+                with self._lock:
+                    self.succeeded += 1
+            finally:
+                with self._lock:
+                    self._running -= 1
+                self._queue.task_done()
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "max_depth": self.max_depth,
+            "queued": self._queue.qsize(),
+            "running": self._running,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+        }
@@ -1,23 +1,59 @@
 import os
 import base64
 import json
-from PIL import Image
 from openai import OpenAI
-from io import BytesIO
 from dotenv import load_dotenv
 from flask_cors import CORS
 import requests
-from flask import send_from_directory
+from flask import send_file
 import traceback
 import logging
+import copy
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hmac
+import math
+from io import BytesIO
+from PIL import Image, UnidentifiedImageError
 
-# Set up logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s %(levelname)s %(message)s',
+from admission import ConcurrencyLimiter, TokenBucketLimiter
+from caching import DiskCache, SingleFlight, TTLCache, TieredCache, content_hash
+import server_config
+from upload_sessions import UploadSessionStore
+from headswapper import CircuitBreaker, HeadSwapperClient, HealthMonitor, RequestHedger
+from reference_images import ReferenceImageCache
+from static_files import StaticFileIndex, parse_directory_max_ages
+from image_derivatives import FORMATS, DerivativeStore, negotiate_format, snap_width
+from preprocessing import ImagePreprocessor
+from normalization import UploadNormalizer
+from perceptual_hash import (
+    ALGORITHMS as PERCEPTUAL_HASHES,
+    PerceptualHashIndex,
+    colour_distance,
+    colour_signature,
 )
+from skin_tone import SkinToneEstimator
+from subject_crop import SubjectCropper
+from security_config import MAX_FILE_SIZE, RATE_LIMIT_REQUESTS, RATE_LIMIT_WINDOW
+from jobs import JobQueue, QueueFullError
+from metrics import Registry
+from openai_governor import GovernorTimeout, call_outcome, openai_governor
+from result_store import ResultStore, decode_data_uri
+from uploads import MAX_CONTENT_LENGTH, UploadRequest, UploadStream
+
 
-# Set Flask log level to DEBUG
+def configure_logging(level=None):
+    """
+    Set up root logging. Called from create_app() rather than at import time
+    so that importing this module leaves logging to the importer. The
+    clients, executors and caches are still created at import.
+    """
+    logging.basicConfig(
+        level=level or server_config.LOG_LEVEL,
+        format='%(asctime)s %(levelname)s %(message)s',
+    )
+
+# Route Flask's logger through the root logger
 import flask
 flask.logging.create_logger = lambda app: logging.getLogger('flask.app')
 
@@ -89,6 +125,8 @@ SKIN_TONES = [
     },
 ]
 
+SKIN_TONE_NAMES = {st["name"] for st in SKIN_TONES}
+
 BODY_TYPE_DESCRIPTIONS = "\n".join(
     [f"- {bt['name']}: {bt['base_description']}" for bt in BASE_BODY_TYPES]
 )
@@ -98,16 +136,8 @@ SKIN_TONE_DESCRIPTIONS = "\n".join(
 
 # Get and clean the API key
 api_key = os.getenv("OPENAI_API_KEY", "").strip()
-logging.debug(f"DEBUG: API key length: {len(api_key)}")
-logging.debug(f"DEBUG: API key starts with: {api_key[:10]}...")
-logging.debug(f"DEBUG: API key ends with: ...{api_key[-10:]}")
-client = OpenAI(api_key=api_key)
-
-
-def image_to_base64(image):
-    buffered = BytesIO()
-    image.save(buffered, format="JPEG", quality=95)
-    return base64.b64encode(buffered.getvalue()).decode()
+# The governor handles 429s for every caller; SDK retries would bypass it
+client = OpenAI(api_key=api_key, max_retries=0)
 
 
 def get_system_prompt():
@@ -135,20 +165,376 @@ def get_system_prompt():
     )
 
 
-def analyze_user_image_from_bytes(image_bytes):
+# Analysis results keyed by analysis_cache_key()
+analysis_cache = TieredCache(
+    TTLCache(
+        max_entries=server_config.ANALYSIS_CACHE_MAX_ENTRIES,
+        ttl=server_config.ANALYSIS_CACHE_TTL,
+    ),
+    disk=(
+        DiskCache(
+            server_config.ANALYSIS_CACHE_DIR,
+            ttl=server_config.ANALYSIS_CACHE_TTL,
+            suffix=".json",
+        )
+        if server_config.ANALYSIS_CACHE_DIR
+        else None
+    ),
+    encode=lambda value: json.dumps(value).encode(),
+    decode=json.loads,
+)
+
+# HeadSwapper output images (data URIs) keyed by headswap_cache_key()
+headswap_cache = TieredCache(
+    TTLCache(
+        max_entries=server_config.HEADSWAP_CACHE_MAX_ENTRIES,
+        ttl=server_config.HEADSWAP_CACHE_TTL,
+        max_bytes=server_config.HEADSWAP_CACHE_MAX_BYTES,
+    ),
+    disk=(
+        DiskCache(
+            server_config.HEADSWAP_CACHE_DIR,
+            ttl=server_config.HEADSWAP_CACHE_TTL,
+            suffix=".txt",
+            max_bytes=server_config.HEADSWAP_CACHE_DISK_MAX_BYTES,
+        )
+        if server_config.HEADSWAP_CACHE_DIR
+        else None
+    ),
+    encode=str.encode,
+    decode=bytes.decode,
+)
+
+# Perceptual hash -> (upload content hash, colour signature), for re-saved or
+# re-taken photos
+near_duplicates = (
+    PerceptualHashIndex(
+        max_distance=server_config.ANALYSIS_DEDUP_MAX_DISTANCE,
+        max_entries=server_config.ANALYSIS_DEDUP_MAX_ENTRIES,
+    )
+    if server_config.ANALYSIS_DEDUP_MAX_DISTANCE >= 0
+    else None
+)
+perceptual_hash = PERCEPTUAL_HASHES[server_config.ANALYSIS_DEDUP_ALGORITHM]
+
+analysis_preprocessor = ImagePreprocessor(
+    max_edge=server_config.ANALYSIS_RESOLUTION,
+    resample=server_config.ANALYSIS_RESAMPLE,
+    quality=server_config.ANALYSIS_JPEG_QUALITY,
+    passthrough_max_bytes=server_config.ANALYSIS_PASSTHROUGH_MAX_BYTES,
+)
+
+skin_tone_estimator = SkinToneEstimator()
+
+subject_cropper = (
+    SubjectCropper(
+        detect_edge=server_config.SUBJECT_CROP_DETECT_EDGE,
+        min_face=server_config.SUBJECT_CROP_MIN_FACE,
+    )
+    if server_config.SUBJECT_CROP_ANALYSIS or server_config.SUBJECT_CROP_HEADSWAP
+    else None
+)
+
+upload_normalizer = (
+    UploadNormalizer(
+        max_edge=server_config.HEADSWAP_MAX_EDGE,
+        output_format=server_config.HEADSWAP_IMAGE_FORMAT,
+        quality=server_config.HEADSWAP_IMAGE_QUALITY,
+        resample=server_config.HEADSWAP_RESAMPLE,
+        passthrough_max_bytes=server_config.HEADSWAP_PASSTHROUGH_MAX_BYTES,
+    )
+    if server_config.HEADSWAP_NORMALIZE
+    else None
+)
+
+# Shared by all /api/analyze-batch requests, so the fan-out stays bounded
+# however many batches arrive at once
+batch_executor = ThreadPoolExecutor(
+    max_workers=server_config.ANALYSIS_BATCH_CONCURRENCY, thread_name_prefix="analysis-batch"
+)
+
+result_store = ResultStore(
+    max_entries=server_config.RESULT_STORE_MAX_ENTRIES,
+    ttl=server_config.RESULT_STORE_TTL,
+    max_bytes=server_config.RESULT_STORE_MAX_BYTES,
+)
+
+upload_sessions = UploadSessionStore(
+    max_entries=server_config.UPLOAD_SESSION_MAX_ENTRIES,
+    ttl=server_config.UPLOAD_SESSION_TTL,
+    max_bytes=server_config.UPLOAD_SESSION_MAX_BYTES,
+)
+
+# Identical concurrent requests (double clicks, frontend retries) share one
+# upstream call instead of each paying for GPT-4o and the HeadSwapper
+analysis_flights = SingleFlight()
+headswap_flights = SingleFlight()
+
+# Scraped at /metrics
+metrics_registry = Registry()
+stage_seconds = metrics_registry.histogram(
+    "tryon_stage_duration_seconds",
+    "Time spent in each stage of the analysis and try-on pipeline",
+    labelnames=("stage",),
+)
+fallbacks_total = metrics_registry.counter(
+    "tryon_fallbacks_total",
+    "Try-ons answered with the reference image because the HeadSwapper was unavailable",
+)
+upstream_errors_total = metrics_registry.counter(
+    "tryon_upstream_errors_total",
+    "Failed calls to upstream services",
+    labelnames=("upstream",),
+)
+requests_in_flight = metrics_registry.gauge(
+    "http_requests_in_flight",
+    "Requests currently being handled",
+    labelnames=("endpoint",),
+)
+skin_tone_checks_total = metrics_registry.counter(
+    "skin_tone_checks_total",
+    "Local skin tone estimates compared with the model's skin_color",
+    labelnames=("outcome",),
+)
+admission_rejections_total = metrics_registry.counter(
+    "admission_rejections_total",
+    "Requests refused by admission control",
+    labelnames=("reason",),
+)
+analysis_lookups_total = metrics_registry.counter(
+    "analysis_cache_lookups_total",
+    "Analysis cache lookups by result: exact, near_duplicate or miss",
+    labelnames=("result",),
+)
+
+# Admission control for the endpoints that call OpenAI and the HeadSwapper
+rate_limiter = TokenBucketLimiter(RATE_LIMIT_REQUESTS, RATE_LIMIT_WINDOW)
+# Per-image budget for /api/analyze-batch
+batch_rate_limiter = TokenBucketLimiter(server_config.ANALYSIS_BATCH_RATE_LIMIT, RATE_LIMIT_WINDOW)
+concurrency_limiter = ConcurrencyLimiter(
+    server_config.ADMISSION_MAX_CONCURRENT,
+    max_waiting=server_config.ADMISSION_MAX_WAITING,
+    wait_timeout=server_config.ADMISSION_WAIT_TIMEOUT,
+)
+
+
+def analyze_user_image_from_bytes(image_bytes, image_hash=None):
+    image_hash = image_hash or content_hash(image_bytes)
+    cached, fingerprint = lookup_cached_analysis(image_bytes, image_hash)
+    if cached is not None:
+        return cached
+
+    result, shared = analysis_flights.do(
+        image_hash, _analyze_and_store, image_bytes, image_hash, fingerprint
+    )
+    if shared:
+        logging.debug(f"DEBUG: Joined in-flight analysis for {image_hash[:12]}")
+        return copy.deepcopy(result)
+    return result
+
+
+def _analyze_and_store(image_bytes, image_hash, fingerprint):
+    # Runs as the flight leader and stores the result before the flight
+    # ends, so a request arriving right after it finds the cache filled
+    cached = get_cached_analysis(image_hash)
+    if cached is not None:
+        return cached
+    result = _analyze_image_uncached(image_bytes)
+    store_analysis(image_hash, fingerprint, result)
+    return result
+
+
+def analysis_cache_key(image_hash):
+    """
+    Cache key of an analysis: the upload and the settings that shape the
+    cached result, so that changing them (the disk tier outlives restarts)
+    does not serve analyses made under the old ones.
+
+    Args:
+        image_hash (str): Content hash of the uploaded image
+
+    Returns:
+        str: Hex encoded SHA-256 digest
+    """
+    key = {
+        "image": image_hash,
+        # The analyzed image is a function of the upload and these settings
+        "subject_crop": server_config.SUBJECT_CROP_ANALYSIS,
+        "preprocessing": analysis_preprocessor.signature,
+        # apply_skin_tone_estimate() may rewrite skin_color
+        "skin_tone_mode": server_config.SKIN_TONE_MODE,
+        "skin_tone_min_confidence": server_config.SKIN_TONE_MIN_CONFIDENCE,
+    }
+    return content_hash(json.dumps(key, sort_keys=True).encode())
+
+
+def lookup_cached_analysis(image_bytes, image_hash):
+    """
+    Find a cached analysis for the exact upload or, failing that, for a
+    near-duplicate of it with similar colours. A near-duplicate's analysis
+    is not cached under the upload's own hash.
+
+    Returns:
+        tuple: (copy of the cached analysis or None, (perceptual hash, colour
+        signature) of the upload to pass to store_analysis(), None if they
+        were not computed)
+    """
+    cached = analysis_cache.get(analysis_cache_key(image_hash))
+    if cached is not None:
+        logging.debug(f"DEBUG: Analysis cache hit for {image_hash[:12]}")
+        analysis_lookups_total.inc(result="exact")
+        return copy.deepcopy(cached), None
+    if near_duplicates is None:
+        analysis_lookups_total.inc(result="miss")
+        return None, None
+
+    try:
+        with stage_seconds.time(stage="perceptual_hash"):
+            fingerprint = (perceptual_hash(image_bytes), colour_signature(image_bytes))
+    except Exception as e:
+        logging.debug(f"DEBUG: Perceptual hash failed: {e}")
+        analysis_lookups_total.inc(result="miss")
+        return None, None
+
+    def similar_colours(entry):
+        return (
+            colour_distance(fingerprint[1], entry[1])
+            <= server_config.ANALYSIS_DEDUP_MAX_COLOUR_DISTANCE
+        )
+
+    match = near_duplicates.find(fingerprint[0], accept=similar_colours)
+    if match is not None:
+        (matched_hash, _), distance = match
+        cached = analysis_cache.get(analysis_cache_key(matched_hash))
+        if cached is not None:
+            logging.debug(
+                f"DEBUG: Near-duplicate of {matched_hash[:12]} (distance {distance}) "
+                f"for {image_hash[:12]}"
+            )
+            analysis_lookups_total.inc(result="near_duplicate")
+            return copy.deepcopy(cached), fingerprint
+    analysis_lookups_total.inc(result="miss")
+    return None, fingerprint
+
+
+def get_cached_analysis(image_hash):
+    """
+    Copy of the analysis cached for an upload, or None. Flight leaders check
+    again with this: a flight that ended after their first lookup may have
+    stored the analysis in the meantime.
+    """
+    cached = analysis_cache.get(analysis_cache_key(image_hash))
+    return copy.deepcopy(cached) if cached is not None else None
+
+
+def store_analysis(image_hash, fingerprint, result):
+    """
+    Cache a fresh analysis under analysis_cache_key() and index its
+    perceptual hash for near-duplicate lookups.
+    """
+    analysis_cache.set(analysis_cache_key(image_hash), copy.deepcopy(result))
+    if near_duplicates is not None and fingerprint is not None:
+        perceptual, colours = fingerprint
+        near_duplicates.add(perceptual, (image_hash, colours))
+
+
+def analysis_busy_error():
+    """
+    503 for an analysis that could not get an OpenAI call through, asking the
+    client to retry once any throttle pause is over.
+    """
+    retry_after = max(1, openai_governor.chat.pause_remaining())
+    return TryOnError("Image analysis is busy. Please retry shortly.", 503, retry_after=retry_after)
+
+
+def _analyze_image_uncached(image_bytes):
+    params = build_analysis_params(image_bytes)
+    try:
+        with stage_seconds.time(stage="gpt4o"):
+            response = openai_governor.call(
+                "chat",
+                client.chat.completions.create,
+                timeout=server_config.OPENAI_ACQUIRE_TIMEOUT,
+                **params,
+            )
+    except GovernorTimeout:
+        raise analysis_busy_error()
+    except Exception as e:
+        upstream_errors_total.inc(upstream="openai")
+        logging.debug(f"DEBUG: Error in OpenAI API call: {e}")
+        if call_outcome(e)[0] == "throttled":
+            raise analysis_busy_error()
+        raise
+    logging.debug(f"DEBUG: OpenAI API call successful")
+    return apply_skin_tone_estimate(parse_analysis_response(response), image_bytes)
+
+
+def apply_skin_tone_estimate(result, image_bytes):
+    """
+    Cross-check the model's skin_color against the local ITA estimate and,
+    depending on SKIN_TONE_MODE, fill in or replace it.
+
+    Args:
+        result (dict): Parsed analysis
+        image_bytes (bytes): The analyzed image
+
+    Returns:
+        dict: The analysis with a skin_tone_estimate entry added
+    """
+    mode = server_config.SKIN_TONE_MODE
+    if mode == "off":
+        return result
+    try:
+        with stage_seconds.time(stage="skin_tone"):
+            estimate = skin_tone_estimator.estimate(image_bytes)
+    except Exception as e:
+        logging.warning(f"Skin tone estimate failed: {e}")
+        return result
+
+    metadata = result.get("metadata", {})
+    model_skin = metadata.get("skin_color")
+    if estimate["skin_color"] is None:
+        skin_tone_checks_total.inc(outcome="no_estimate")
+    else:
+        estimate["agrees"] = estimate["skin_color"] == model_skin
+        skin_tone_checks_total.inc(outcome="agree" if estimate["agrees"] else "disagree")
+        confident = estimate["confidence"] >= server_config.SKIN_TONE_MIN_CONFIDENCE
+        known_skin = model_skin in SKIN_TONE_NAMES
+        # "N/A" means the model found no person, which the estimate cannot overrule
+        no_person = str(model_skin).upper() == "N/A"
+        if confident and not no_person and (
+            (mode == "fill" and not known_skin) or (mode == "prefer" and not estimate["agrees"])
+        ):
+            logging.debug(f"DEBUG: skin_color {model_skin} -> {estimate['skin_color']} from ITA estimate")
+            metadata["skin_color"] = estimate["skin_color"]
+    result["skin_tone_estimate"] = estimate
+    return result
+
+
+def build_analysis_params(image_bytes):
+    """
+    Prepare the image and build the chat completion request for the analysis.
+
+    Args:
+        image_bytes (bytes): Raw uploaded image
+
+    Returns:
+        dict: Keyword arguments for client.chat.completions.create
+    """
     logging.debug(f"DEBUG: Starting image analysis, image size: {len(image_bytes)} bytes")
+    if server_config.SUBJECT_CROP_ANALYSIS:
+        with stage_seconds.time(stage="subject_crop"):
+            image_bytes = subject_cropper.crop(image_bytes, "person")
     try:
-        img = Image.open(BytesIO(image_bytes))
-        logging.debug(f"DEBUG: Image opened successfully, size: {img.size}, mode: {img.mode}")
-        width, height = img.size
-        if width > 2000 or height > 2000:
-            img.thumbnail((2000, 2000), Image.Resampling.LANCZOS)
-            logging.debug(f"DEBUG: Image resized to: {img.size}")
-        if img.mode == "RGBA":
-            img = img.convert("RGB")
-            logging.debug(f"DEBUG: Image converted to RGB")
-        img_base64 = image_to_base64(img)
+        prepared = analysis_preprocessor.prepare(image_bytes)
+        for stage, seconds in prepared["timings"].items():
+            stage_seconds.observe(seconds, stage=stage)
+        img_base64 = prepared["base64"]
         logging.debug(f"DEBUG: Image converted to base64, length: {len(img_base64)}")
+    except (UnidentifiedImageError, OSError) as e:
+        # Valid magic bytes followed by a corrupt or truncated body
+        logging.debug(f"DEBUG: Could not decode image: {e}")
+        raise TryOnError("Invalid image file. Please upload a different image.", 400)
     except Exception as e:
         logging.debug(f"DEBUG: Error in image processing: {e}")
         raise
@@ -176,52 +562,345 @@ def analyze_user_image_from_bytes(image_bytes):
     }
 
     logging.debug(f"DEBUG: Calling OpenAI API with image base64 length: {len(img_base64)}")
+    return params
+
+
+def parse_analysis_response(response):
+    """
+    Parse a chat completion into the analysis dict and normalize the skin color.
+    """
+    parsed_response = json.loads(response.choices[0].message.content)
+    logging.debug(f"DEBUG: Parsed response: {parsed_response}")
+    sc = parsed_response["metadata"]["skin_color"].lower()
+    parsed_response["metadata"]["skin_color"] = NORMALIZE_SKIN.get(sc, sc)
+    logging.debug(f"DEBUG: Final response: {parsed_response}")
+    return parsed_response
+
+
+class TryOnError(Exception):
+    """
+    Expected failure in the try-on pipeline, carrying the HTTP status to return.
+    """
+
+    def __init__(self, message, status_code=500, retry_after=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        # Response headers, e.g. Retry-After for a 503
+        self.headers = {}
+        if retry_after is not None:
+            self.headers["Retry-After"] = str(math.ceil(retry_after))
+
+
+class HeadSwapperUnavailable(TryOnError):
+    """
+    The HeadSwapper could not be reached or failed; the try-on falls back to
+    the reference image.
+    """
+
+    def __init__(self):
+        super().__init__("Failed to connect to HeadSwapper service", 503)
+
+
+def read_upload(file):
+    """
+    Validate an uploaded image file and read its content.
+
+    Args:
+        file: Uploaded file object (werkzeug FileStorage)
+
+    Returns:
+        tuple: (file_content, image_hash) with the SHA-256 hex digest of the content
+
+    Raises:
+        TryOnError: If the file type or size is not allowed, or the content
+            is not a readable image
+    """
+    # Validate file type
+    if not file.filename or not file.filename.lower().endswith(
+        (".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp")
+    ):
+        logging.debug(f"DEBUG: Invalid file type: {file.filename}")
+        raise TryOnError("Invalid file type. Please upload an image.", 400)
+
+    stream = file.stream
+    if isinstance(stream, UploadStream):
+        # Size, hash and content type were checked while the upload streamed in
+        if stream.image_type is None:
+            logging.debug(f"DEBUG: Content of {file.filename} is not a supported image")
+            raise TryOnError("Invalid file type. Please upload an image.", 400)
+        file_content, image_hash = stream.getvalue(), stream.sha256
+    else:
+        # Read file content once
+        file_content = file.read()
+
+        # Validate file size (max 10MB)
+        if len(file_content) > MAX_FILE_SIZE:
+            raise TryOnError("File too large. Maximum size is 10MB.", 413)
+        image_hash = content_hash(file_content)
+
+    # Magic bytes only say what the file claims to be; parse the header too
     try:
-        response = client.chat.completions.create(**params)
-        logging.debug(f"DEBUG: OpenAI API call successful")
-        parsed_response = json.loads(response.choices[0].message.content)
-        logging.debug(f"DEBUG: Parsed response: {parsed_response}")
-        sc = parsed_response["metadata"]["skin_color"].lower()
-        parsed_response["metadata"]["skin_color"] = NORMALIZE_SKIN.get(sc, sc)
-        logging.debug(f"DEBUG: Final response: {parsed_response}")
-        return parsed_response
-    except Exception as e:
-        logging.debug(f"DEBUG: Error in OpenAI API call: {e}")
-        raise
+        Image.open(BytesIO(file_content))
+    except (UnidentifiedImageError, OSError) as e:
+        logging.debug(f"DEBUG: Could not parse image {file.filename}: {e}")
+        raise TryOnError("Invalid image file. Please upload a different image.", 400)
+    return file_content, image_hash
+
+
+def register_upload(image_bytes, analysis, image_hash=None):
+    """
+    Store an analyzed upload so /api/swap-head can reuse it by handle.
+
+    The session keeps the image as normalized for the HeadSwapper, which is
+    what later try-ons send and usually a fraction of the upload's size. The
+    hash stays that of the original upload, so cache keys match those of a
+    direct upload of the same file.
+
+    Returns:
+        dict: Analysis response including the upload handle
+    """
+    image_hash = image_hash or content_hash(image_bytes)
+    normalized_bytes, _ = normalize_upload(image_bytes)
+    upload_id = upload_sessions.create(
+        normalized_bytes, copy.deepcopy(analysis), image_hash=image_hash
+    )
+    return dict(analysis, upload_id=upload_id, upload_expires_in=int(upload_sessions.ttl))
+
+
+def resolve_upload(upload_id, file):
+    """
+    Find the image for a try-on, either from an upload session or a new upload.
+
+    Args:
+        upload_id (str): Handle returned by /api/analyze-user-image, may be empty
+        file: Uploaded file object, or None
+
+    Returns:
+        tuple: (image_bytes, image_hash, analysis), where analysis is None when
+        the image still has to be analyzed
+    """
+    session = upload_sessions.get(upload_id)
+    if session is not None:
+        logging.debug(f"DEBUG: Reusing upload session {upload_id[:8]}...")
+        return (
+            session["image_bytes"],
+            session["image_hash"],
+            copy.deepcopy(session["analysis"]),
+        )
+    if file is None:
+        if upload_id:
+            raise TryOnError("Upload expired. Please upload the image again.", 410)
+        raise TryOnError("No image file provided", 400)
+    return (*read_upload(file), None)
+
+
+# Headers carrying the try-on metadata when the result is returned as raw bytes
+RESULT_HEADERS = ["X-Analysis", "X-Pregenerated-Image-Url", "X-Warning"]
+
+# Origins allowed to call the API from a browser
+CORS_ORIGINS = [
+    "https://gazmanclone.vercel.app",
+    "https://66north-jade.vercel.app",  # Add Vercel frontend domain
+    "https://jd-sports.vercel.app",
+    "http://localhost:3000",
+    "http://localhost:5173",
+    "http://localhost:5174",
+    "http://127.0.0.1:5173",
+    "http://127.0.0.1:5174",
+    "http://10.50.8.142:5173",
+    "http://10.50.8.142:5174"
+]
 
 
 # --- Flask API for frontend integration ---
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 
 app = Flask(__name__)
+# Uploads are streamed into memory and rejected as soon as they cross the limit
+app.request_class = UploadRequest
+app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
+app.config["USE_X_SENDFILE"] = server_config.STATIC_USE_X_SENDFILE
 
 # Secure CORS configuration
 CORS(
     app,
-    origins=[
-        "https://gazmanclone.vercel.app",
-        "https://66north-jade.vercel.app",  # Add Vercel frontend domain
-        "https://jd-sports.vercel.app",
-        "http://localhost:3000",
-        "http://localhost:5173",
-        "http://localhost:5174",
-        "http://127.0.0.1:5173",
-        "http://127.0.0.1:5174",
-        "http://10.50.8.142:5173",
-        "http://10.50.8.142:5174"
-    ],
+    origins=CORS_ORIGINS,
     supports_credentials=True,
     allow_headers=["Content-Type"],
+    expose_headers=RESULT_HEADERS,
     methods=["GET", "POST", "OPTIONS"],
 )
 
 
+@app.before_request
+def track_request_start():
+    requests_in_flight.inc(endpoint=request.endpoint or "unknown")
+
+
+@app.teardown_request
+def track_request_end(exc):
+    requests_in_flight.dec(endpoint=request.endpoint or "unknown")
+    # Set by UploadRequest when a multipart body was parsed
+    upload_seconds = getattr(request, "upload_read_seconds", None)
+    if upload_seconds is not None:
+        stage_seconds.observe(upload_seconds, stage="upload_read")
+
+
+_warned_unconfigured_proxy = False
+
+
+def client_id(req):
+    """
+    Identify the client a request is rate limited as: the peer address or,
+    with ADMISSION_PROXY_HOPS set, the address the outermost trusted proxy
+    saw.
+    """
+    global _warned_unconfigured_proxy
+    forwarded = [
+        address.strip()
+        for address in req.headers.get("X-Forwarded-For", "").split(",")
+        if address.strip()
+    ]
+    hops = server_config.ADMISSION_PROXY_HOPS
+    if hops and len(forwarded) >= hops:
+        # Each trusted proxy appends the address it received from, so the
+        # rightmost entries are the trustworthy ones
+        return forwarded[-hops]
+    if forwarded and not hops and not _warned_unconfigured_proxy:
+        _warned_unconfigured_proxy = True
+        logging.warning(
+            "Requests arrive through a proxy but ADMISSION_PROXY_HOPS is 0; "
+            "all clients share one rate limit bucket"
+        )
+    return req.remote_addr or "unknown"
+
+
+def admit_request(client, blocking=True, limiter=None):
+    """
+    Apply the per-client rate limit and take a concurrency slot.
+
+    Args:
+        client (str): Client id from client_id()
+        blocking (bool): Wait in the bounded queue when all slots are busy
+        limiter (ConcurrencyLimiter, optional): Slots to take from, by
+            default concurrency_limiter
+
+    Returns:
+        tuple: (body, status, headers) refusal to return to the client, or
+        None if the request was admitted and holds a slot that must be
+        released with limiter.release()
+    """
+    limiter = limiter or concurrency_limiter
+    if server_config.RATE_LIMIT_ENABLED:
+        retry_after = rate_limiter.acquire(client)
+        if retry_after:
+            admission_rejections_total.inc(reason="rate_limit")
+            return (
+                {"error": "Too many requests. Please slow down."},
+                429,
+                {"Retry-After": str(math.ceil(retry_after))},
+            )
+    if not limiter.acquire(blocking=blocking):
+        admission_rejections_total.inc(reason="overload")
+        return (
+            {"error": "Server is busy. Please retry shortly."},
+            503,
+            {"Retry-After": str(server_config.ADMISSION_RETRY_AFTER)},
+        )
+    return None
+
+
+def admission_controlled(view=None, blocking=True):
+    """
+    Run a view only if admit_request() lets the request in. The upload body
+    is not read for refused requests.
+
+    Use as @admission_controlled, or @admission_controlled(blocking=False)
+    for views that should be refused rather than queued when all slots are
+    busy.
+    """
+    if view is None:
+        return functools.partial(admission_controlled, blocking=blocking)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        refusal = admit_request(client_id(request), blocking=blocking)
+        if refusal is not None:
+            return refusal
+        try:
+            response = view(*args, **kwargs)
+        except BaseException:
+            concurrency_limiter.release()
+            raise
+        if isinstance(response, Response) and response.is_streamed:
+            # Hold the slot until the stream has been sent
+            response.call_on_close(concurrency_limiter.release)
+        else:
+            concurrency_limiter.release()
+        return response
+
+    return wrapper
+
+
+@app.route("/metrics")
+def metrics_api():
+    return metrics_registry.render(), 200, {"Content-Type": Registry.CONTENT_TYPE}
+
+
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    return jsonify({"error": "File too large. Maximum size is 10MB."}), 413
+
+
 @app.route("/")
 def health_check():
     return jsonify({"status": "ok", "message": "Server is running"}), 200
 
 
+@app.route("/api/stats")
+def stats_api():
+    if not server_config.STATS_TOKEN:
+        return jsonify({"error": "Not found"}), 404
+    expected = f"Bearer {server_config.STATS_TOKEN}"
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), expected):
+        return jsonify({"error": "Unauthorized"}), 401, {"WWW-Authenticate": "Bearer"}
+    return jsonify(
+        {
+            "analysis_cache": analysis_cache.stats(),
+            "near_duplicates": near_duplicates.stats() if near_duplicates else {"enabled": False},
+            "headswap_cache": headswap_cache.stats(),
+            "upload_normalizer": upload_normalizer.stats() if upload_normalizer else {"enabled": False},
+            "subject_crop": subject_cropper.stats() if subject_cropper else {"enabled": False},
+            "analysis_preprocessing": analysis_preprocessor.stats(),
+            "upload_sessions": upload_sessions.stats(),
+            "result_store": result_store.stats(),
+            "singleflight": {
+                "analysis": analysis_flights.stats(),
+                "headswap": headswap_flights.stats(),
+            },
+            "tryon_jobs": tryon_jobs.stats(),
+            "openai": openai_governor.stats(),
+            "admission": {
+                "rate_limit": rate_limiter.stats(),
+                "batch_rate_limit": batch_rate_limiter.stats(),
+                "concurrency": concurrency_limiter.stats(),
+            },
+            "headswapper": {
+                "pool": headswapper_client.stats(),
+                "breaker": headswapper_breaker.stats(),
+                "health": headswapper_health.stats(),
+                "hedging": headswapper_hedger.stats(),
+            },
+            "reference_images": reference_images.stats(),
+            "static_files": static_files.stats(),
+            "image_derivatives": image_derivatives.stats(),
+        }
+    ), 200
+
+
 @app.route("/api/analyze-user-image", methods=["POST"])
+@admission_controlled
 def analyze_user_image_api():
     logging.debug("DEBUG: /api/analyze-user-image endpoint called")
     logging.debug(f"DEBUG: Request method: {request.method}")
@@ -235,21 +914,17 @@ def analyze_user_image_api():
     file = request.files["image"]
     logging.debug(f"DEBUG: Got file: {file.filename}, content type: {file.content_type}")
 
-    # Validate file type
-    if not file.filename or not file.filename.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp")):
-        logging.debug(f"DEBUG: Invalid file type: {file.filename}")
-        return jsonify({"error": "Invalid file type. Please upload an image."}), 400
-
-    # Read file content once
-    file_content = file.read()
-    
-    # Validate file size (max 10MB)
-    if len(file_content) > 10 * 1024 * 1024:
-        return jsonify({"error": "File too large. Maximum size is 10MB."}), 400
+    try:
+        file_content, image_hash = read_upload(file)
+    except TryOnError as e:
+        return jsonify({"error": e.message}), e.status_code, e.headers
 
     try:
-        result = analyze_user_image_from_bytes(file_content)
-        return jsonify(result)
+        result = analyze_user_image_from_bytes(file_content, image_hash)
+        # Let /api/swap-head reuse this upload and its analysis by handle
+        return jsonify(register_upload(file_content, result, image_hash))
+    except TryOnError as e:
+        return jsonify({"error": e.message}), e.status_code, e.headers
     except Exception as e:
         # Log the actual error for debugging but don't expose it
         logging.error(f"Error in analyze_user_image_api: {e}")
@@ -259,191 +934,781 @@ def analyze_user_image_api():
         return jsonify({"error": "Internal server error. Please try again."}), 500
 
 
+def analyze_batch_item(file):
+    """
+    Analyze one image of a batch.
+
+    Returns:
+        dict: filename plus either the analysis or an error and status_code
+    """
+    item = {"filename": file.filename}
+    try:
+        image_bytes, image_hash = read_upload(file)
+        item["analysis"] = analyze_user_image_from_bytes(image_bytes, image_hash)
+    except TryOnError as e:
+        item.update(error=e.message, status_code=e.status_code)
+    except Exception as e:
+        logging.error(f"Error analyzing batch item {file.filename}: {e}")
+        item.update(error="Internal server error. Please try again.", status_code=500)
+    return item
+
+
+@app.route("/api/analyze-batch", methods=["POST"])
+@admission_controlled
+def analyze_batch_api():
+    """
+    Analyze many images from one multipart request (repeated "images" fields).
+    Items are preprocessed and analyzed in parallel and returned in request
+    order, each with its own analysis or error.
+    """
+    # Must be set before the body is parsed
+    request.max_content_length = server_config.ANALYSIS_BATCH_MAX_BYTES
+    files = request.files.getlist("images")
+    if not files:
+        return jsonify({"error": "No image files provided"}), 400
+    max_items = server_config.ANALYSIS_BATCH_MAX_ITEMS
+    if server_config.RATE_LIMIT_ENABLED:
+        # A larger batch could never be admitted
+        max_items = min(max_items, batch_rate_limiter.capacity)
+    if len(files) > max_items:
+        return jsonify({"error": f"Too many images. Maximum is {max_items}."}), 400
+    if server_config.RATE_LIMIT_ENABLED:
+        # admission_controlled charged the request; the images come out of
+        # the batch budget, all or none
+        retry_after = batch_rate_limiter.acquire(client_id(request), len(files))
+        if retry_after:
+            admission_rejections_total.inc(reason="rate_limit")
+            return (
+                jsonify({"error": "Too many requests. Please slow down."}),
+                429,
+                {"Retry-After": str(math.ceil(retry_after))},
+            )
+
+    results = list(batch_executor.map(analyze_batch_item, files))
+    failed = sum(1 for item in results if "error" in item)
+    return jsonify(
+        {"results": results, "succeeded": len(results) - failed, "failed": failed}
+    ), 200
+
+
 # Configure image directory from environment variable or use default
 IMAGES_DIR = os.getenv("IMAGES_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "frontend", "public", "images"))
-logging.debug(f"DEBUG: IMAGES_DIR = {IMAGES_DIR}")
+
+
+headswapper_client = HeadSwapperClient(
+    server_config.HEADSWAPPER_URL,
+    pool_size=server_config.HEADSWAPPER_POOL_SIZE,
+    connect_timeout=server_config.HEADSWAPPER_CONNECT_TIMEOUT,
+    read_timeout=server_config.HEADSWAPPER_READ_TIMEOUT,
+    max_retries=server_config.HEADSWAPPER_MAX_RETRIES,
+)
+headswapper_breaker = CircuitBreaker(
+    failure_threshold=server_config.HEADSWAPPER_FAILURE_THRESHOLD,
+    reset_timeout=server_config.HEADSWAPPER_RESET_TIMEOUT,
+)
+headswapper_hedger = RequestHedger(
+    percentile=server_config.HEADSWAPPER_HEDGE_PERCENTILE,
+    budget_ratio=server_config.HEADSWAPPER_HEDGE_BUDGET,
+    min_samples=server_config.HEADSWAPPER_HEDGE_MIN_SAMPLES,
+    min_delay=server_config.HEADSWAPPER_HEDGE_MIN_DELAY,
+    max_workers=server_config.HEADSWAPPER_POOL_SIZE * 2,
+    # A 5xx from one copy should not beat a success from the other
+    is_success=lambda response: response.status_code < 500,
+)
+headswapper_health = HealthMonitor(
+    headswapper_client,
+    headswapper_breaker,
+    interval=server_config.HEADSWAPPER_HEALTH_INTERVAL,
+)
+
+# Reference images are encoded once and served from memory afterwards
+reference_images = ReferenceImageCache(
+    os.path.join(IMAGES_DIR, "bodytypes", "headswapper"),
+    revalidate_interval=server_config.REFERENCE_CACHE_REVALIDATE_INTERVAL,
+)
+
+# Size, mtime and strong ETag of everything under /images
+static_files = StaticFileIndex(
+    IMAGES_DIR,
+    max_age=server_config.STATIC_CACHE_MAX_AGE,
+    directory_max_ages=parse_directory_max_ages(server_config.STATIC_CACHE_DIRECTORY_MAX_AGES),
+    revalidate_interval=server_config.REFERENCE_CACHE_REVALIDATE_INTERVAL,
+)
+
+image_derivatives = DerivativeStore(
+    DiskCache(
+        server_config.IMAGE_DERIVATIVE_DIR,
+        suffix="",
+        max_bytes=server_config.IMAGE_DERIVATIVE_MAX_BYTES,
+    ),
+    quality=server_config.IMAGE_DERIVATIVE_QUALITY,
+)
+
+
+def resolve_image_request(filename, args, accept_mimetypes):
+    """
+    Work out what /images/<filename> serves: the file itself or, when a width
+    or format is requested, a resized and re-encoded derivative.
+
+    Args:
+        filename (str): Path relative to IMAGES_DIR
+        args (MultiDict): Query parameters (width, format)
+        accept_mimetypes (MIMEAccept): Parsed Accept header, used when no
+            format is requested
+
+    Returns:
+        dict: path or data, mimetype, etag, mtime, max_age, immutable and
+        vary_accept, or None if the file does not exist
+
+    Raises:
+        TryOnError: If width or format is invalid
+    """
+    entry = static_files.lookup(filename)
+    if entry is None:
+        return None
+    image = {
+        "path": entry["path"],
+        "data": None,
+        "mimetype": entry["mimetype"],
+        "etag": entry["etag"],
+        "mtime": entry["mtime"],
+        "max_age": entry["max_age"],
+        "immutable": entry["immutable"],
+        "vary_accept": False,
+    }
+    width = args.get("width", "")
+    image_format = args.get("format", "")
+    if not width and not image_format:
+        return image
+    if not entry["mimetype"].startswith("image/"):
+        raise TryOnError("Resizing is only supported for images", 400)
+
+    if width:
+        if not width.isdigit() or int(width) == 0:
+            raise TryOnError("width must be a positive integer", 400)
+        width = snap_width(int(width))
+    else:
+        width = snap_width(10**9)
+    if image_format:
+        if image_format not in image_derivatives.formats:
+            raise TryOnError(
+                f"format must be one of: {', '.join(image_derivatives.formats)}", 400
+            )
+    else:
+        image_format = negotiate_format(accept_mimetypes, image_derivatives.formats)
+        image["vary_accept"] = True
+
+    image.update(
+        path=None,
+        data=image_derivatives.get(entry, width, image_format),
+        mimetype=FORMATS[image_format][1],
+        etag=f"{entry['etag']}-{width}-{image_format}",
+    )
+    return image
 
 
 def get_reference_image_path(body_type, skin_color, color_prefix=None):
     return f"bodytypes/headswapper/{body_type}/jordan_red_hoodie_reference_{skin_color}.png"
 
 
-def image_file_to_data_uri(path):
-    with open(path, "rb") as img_file:
-        b64 = base64.b64encode(img_file.read()).decode()
-        ext = path.split(".")[-1]
-        return f"data:image/{ext};base64,{b64}"
+def resolve_reference_image(reference_image_rel, analysis):
+    """
+    Resolve the reference image for a try-on.
 
+    Args:
+        reference_image_rel (str): Path relative to IMAGES_DIR requested by the
+            frontend, or empty to pick one from the analysis
+        analysis (dict): Parsed analysis of the user image
 
-@app.route("/api/swap-head", methods=["POST"])
-def swap_head_api():
-    if "image" not in request.files:
-        return jsonify({"error": "No image file provided"}), 400
+    Returns:
+        tuple: (ref_path, pregenerated_image_url)
+    """
+    logging.debug(f"DEBUG: Received reference_image parameter: {reference_image_rel}")
+    if reference_image_rel:
+        # Sanitize the path to prevent directory traversal
+        reference_image_rel = (
+            reference_image_rel.replace("..", "").replace("//", "/").strip("/")
+        )
+        # Always resolve relative to IMAGES_DIR
+        ref_path = os.path.join(IMAGES_DIR, reference_image_rel)
+        logging.debug(f"DEBUG: Resolved reference image path: {ref_path}")
+    else:
+        relative_ref_path = get_reference_image_path(
+            analysis["metadata"]["body_type"], analysis["metadata"]["skin_color"]
+        )
+        ref_path = os.path.join(IMAGES_DIR, relative_ref_path)
+        logging.debug(f"DEBUG: Using default reference image path: {ref_path}")
 
-    file = request.files["image"]
+    # Validate that the reference image path is within allowed directory
+    allowed_base = IMAGES_DIR
+    if not os.path.commonpath([ref_path, allowed_base]) == allowed_base:
+        raise TryOnError("Invalid reference image path", 400)
 
-    # Validate file type
-    if not file.filename or not file.filename.lower().endswith(
-        (".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp")
-    ):
-        return jsonify({"error": "Invalid file type. Please upload an image."}), 400
+    if not os.path.exists(ref_path):
+        logging.debug(f"DEBUG: Reference image not found at: {os.path.abspath(ref_path)}")
+        raise TryOnError("Reference image not found", 404)
+
+    # Construct the public URL for the pregenerated image (extract from ref_path)
+    relative_ref_path = os.path.relpath(ref_path, IMAGES_DIR)
+    pregenerated_image_url = f"/images/{relative_ref_path}"
+    logging.debug(f"DEBUG: Constructed pregenerated_image_url: {pregenerated_image_url}")
+    return ref_path, pregenerated_image_url
+
+
+def headswap_parameters(analysis):
+    """
+    HeadSwapper parameters derived from the analysis.
+
+    Returns:
+        dict: gender and face_description
+    """
+    body_type = analysis["metadata"]["body_type"]
+    skin_color = analysis["metadata"]["skin_color"]
+    gender = analysis["metadata"]["gender"]
+    return {
+        "gender": gender.upper() if gender else None,
+        "face_description": f"Natural head swap preserving skin tone, hair texture, and lighting for {body_type} body type with {skin_color} skin.",
+    }
 
-    # Validate file size (max 10MB)
-    file_content = file.read()
-    if len(file_content) > 10 * 1024 * 1024:
-        return jsonify({"error": "File too large. Maximum size is 10MB."}), 400
 
+def normalize_upload(image_bytes):
+    """
+    Prepare the user image for the HeadSwapper (see HEADSWAP_NORMALIZE).
+
+    Returns:
+        tuple: (image bytes, MIME type)
+    """
+    if upload_normalizer is None:
+        return image_bytes, "image/jpeg"
     try:
-        # Read the original image bytes
-        original_image_bytes = file_content
-        # 1. Analyze the user image (resized for analysis)
-        analysis = analyze_user_image_from_bytes(original_image_bytes)
-        body_type = analysis["metadata"]["body_type"]
-        skin_color = analysis["metadata"]["skin_color"]
-        gender = analysis["metadata"]["gender"]
-
-        # 2. Get the reference image path (allow override from frontend)
-        reference_image_rel = request.form.get("reference_image")
-        logging.debug(f"DEBUG: Received reference_image parameter: {reference_image_rel}")
-        if reference_image_rel:
-            # Sanitize the path to prevent directory traversal
-            reference_image_rel = (
-                reference_image_rel.replace("..", "").replace("//", "/").strip("/")
-            )
-            # Always resolve relative to IMAGES_DIR
-            ref_path = os.path.join(IMAGES_DIR, reference_image_rel)
-            logging.debug(f"DEBUG: Resolved reference image path: {ref_path}")
-        else:
-            relative_ref_path = get_reference_image_path(body_type, skin_color)
-            ref_path = os.path.join(IMAGES_DIR, relative_ref_path)
-            logging.debug(f"DEBUG: Using default reference image path: {ref_path}")
-
-        # Validate that the reference image path is within allowed directory
-        allowed_base = IMAGES_DIR
-        if not os.path.commonpath([ref_path, allowed_base]) == allowed_base:
-            return jsonify({"error": "Invalid reference image path"}), 400
-
-        logging.debug(f"DEBUG: Looking for reference image at: {os.path.abspath(ref_path)}")
-        logging.debug(f"DEBUG: Reference image exists: {os.path.exists(ref_path)}")
-        if os.path.exists(ref_path):
-            logging.debug(f"DEBUG: Reference image size: {os.path.getsize(ref_path)} bytes")
+        with stage_seconds.time(stage="normalize"):
+            return upload_normalizer.normalize(image_bytes)
+    except Exception as e:
+        # The upload passed validation, so let the HeadSwapper have a go at it
+        logging.warning(f"Upload normalization failed, sending the original: {e}")
+        return image_bytes, "image/jpeg"
+
+
+def build_headswap_payload(image_bytes, analysis, reference_image_data_uri):
+    """
+    Build the HeadSwapper request body.
+
+    Args:
+        image_bytes (bytes): User image as uploaded; cropped (with
+            SUBJECT_CROP_HEADSWAP) and normalized here
+        analysis (dict): Parsed analysis of the user image
+        reference_image_data_uri (str): Reference model image as a data URI
+
+    Returns:
+        dict: JSON payload for the HeadSwapper API
+    """
+    if server_config.SUBJECT_CROP_HEADSWAP:
+        with stage_seconds.time(stage="subject_crop"):
+            image_bytes = subject_cropper.crop(image_bytes, "head")
+    normalized_bytes, mime_type = normalize_upload(image_bytes)
+    edit_image_data_uri = f"data:{mime_type};base64," + base64.b64encode(normalized_bytes).decode()
+
+    # reference_image: the source image whose head you want to transplant (user's image)
+    # edit_image: the target image that supplies the new head style (reference model)
+    return {
+        "reference_image": edit_image_data_uri,  # User's image (source head)
+        "edit_image": reference_image_data_uri,  # Reference model (target head style)
+        **headswap_parameters(analysis),
+        "rotation_degrees": 0,  # Default to 0, API will auto-detect if needed
+        "owner_id": "gazman_tryon"
+    }
+
+
+def headswap_cache_key(image_hash, reference_hash, parameters):
+    """
+    Cache key of a head swap: the user image as normalized, the reference
+    image and the parameters sent with them.
+
+    Args:
+        image_hash (str): Content hash of the uploaded user image
+        reference_hash (str): Content hash of the reference image
+        parameters (dict): Result of headswap_parameters()
+
+    Returns:
+        str: Hex encoded SHA-256 digest
+    """
+    key = {
+        "image": image_hash,
+        # The normalized image is a function of the upload and these settings
+        "normalization": upload_normalizer.signature if upload_normalizer else None,
+        "subject_crop": server_config.SUBJECT_CROP_HEADSWAP,
+        "reference": reference_hash,
+        **parameters,
+    }
+    return content_hash(json.dumps(key, sort_keys=True).encode())
+
+
+def fallback_result(reference_image_data_uri, analysis, pregenerated_image_url):
+    """
+    Response used while the HeadSwapper is unavailable.
+    """
+    fallbacks_total.inc()
+    return {
+        "output_image": reference_image_data_uri,  # Return the reference image as fallback
+        "analysis": analysis,
+        "pregenerated_image_url": pregenerated_image_url,
+        "warning": "HeadSwapper API is currently unavailable. Showing reference image as fallback."
+    }
+
+
+# How /api/swap-head returns the output image:
+#   json   - inline base64 data URI in output_image (default)
+#   url    - output_image_url pointing at /results/<id> in the result store
+#   binary - raw image bytes as the body, analysis in the X-* result headers
+RESPONSE_FORMATS = ("json", "url", "binary")
+
+
+def deliver_swap_result(result, response_format="json"):
+    """
+    Shape a try-on result for the requested response format.
+
+    Args:
+        result (dict): output_image, analysis, pregenerated_image_url and an
+            optional warning
+        response_format (str): One of RESPONSE_FORMATS
+
+    Returns:
+        tuple: (body, status, headers) usable as a Flask or Quart view return value
+    """
+    if response_format == "json":
+        return result, 200, {}
+
+    decoded = decode_data_uri(result["output_image"])
+    if response_format == "url":
+        body = {k: v for k, v in result.items() if k != "output_image"}
+        if result.get("warning"):
+            # The fallback output is the reference image, which /images already serves
+            body["output_image_url"] = result["pregenerated_image_url"]
+        elif decoded is not None:
+            mime_type, data = decoded
+            body["output_image_url"] = f"/results/{result_store.put(data, mime_type)}"
         else:
-            logging.debug("DEBUG: Reference image not found!")
-            # List contents of the directory to help debug
-            try:
-                dir_path = os.path.dirname(ref_path)
-                if os.path.exists(dir_path):
-                    logging.debug(f"DEBUG: Directory contents: {os.listdir(dir_path)}")
-                else:
-                    logging.debug(f"DEBUG: Directory does not exist: {dir_path}")
-            except Exception as e:
-                logging.debug(f"DEBUG: Error listing directory: {e}")
-        
-        if not os.path.exists(ref_path):
-            return jsonify({"error": "Reference image not found"}), 404
-
-        # Construct the public URL for the pregenerated image (extract from ref_path)
-        # Get the relative path from the reference image path
-        relative_ref_path = os.path.relpath(ref_path, IMAGES_DIR)
-        pregenerated_image_url = f"/images/{relative_ref_path}"
-        logging.debug(f"DEBUG: Constructed pregenerated_image_url: {pregenerated_image_url}")
-
-        # 3. Read both images as base64 data URIs
-        reference_image_data_uri = image_file_to_data_uri(ref_path)
-        # Use the original, unresized image for HeadSwapper
-        edit_image_data_uri = (
-            "data:image/jpeg;base64," + base64.b64encode(original_image_bytes).decode()
-        )
+            body["output_image_url"] = result["output_image"]
+        return body, 200, {}
 
-        # Test connectivity to HeadSwapper API
-        try:
-            test = requests.get("http://34.122.243.90:8090/headswap", timeout=5)
-            logging.debug(f"Test GET /headswap status: {test.status_code}")
-            logging.debug(f"Test GET /headswap response: {test.text}")
-        except Exception as e:
-            logging.warning(f"Test GET /headswap failed: {e}")
-            logging.warning("WARNING: HeadSwapper service is not available. Using fallback mode.")
-            # Return a fallback response for testing purposes
-            return jsonify({
-                "output_image": reference_image_data_uri,  # Return the reference image as fallback
-                "analysis": analysis,
-                "pregenerated_image_url": pregenerated_image_url,
-                "warning": "HeadSwapper API is currently unavailable. Showing reference image as fallback."
-            })
-
-        # 4. Call the HeadSwapper API
-        url = "http://34.122.243.90:8090/headswap"
-        
-        # Prepare the payload according to the new API documentation
-        # reference_image: the source image whose head you want to transplant (user's image)
-        # edit_image: the target image that supplies the new head style (reference model)
-        payload = {
-            "reference_image": edit_image_data_uri,  # User's image (source head)
-            "edit_image": reference_image_data_uri,  # Reference model (target head style)
-            "gender": gender.upper() if gender else None,
-            "face_description": f"Natural head swap preserving skin tone, hair texture, and lighting for {body_type} body type with {skin_color} skin.",
-            "rotation_degrees": 0,  # Default to 0, API will auto-detect if needed
-            "owner_id": "gazman_tryon"
+    if decoded is None:
+        return result, 200, {}
+    mime_type, data = decoded
+    headers = {
+        "Content-Type": mime_type,
+        "Cache-Control": "no-store",
+        "X-Analysis": json.dumps(result["analysis"]),
+        "X-Pregenerated-Image-Url": result["pregenerated_image_url"],
+    }
+    if result.get("warning"):
+        headers["X-Warning"] = result["warning"]
+    return data, 200, headers
+
+
+def stored_result_response(result_id, if_none_match=None):
+    """
+    Serve an image from the result store.
+
+    Args:
+        result_id (str): Id returned in output_image_url
+        if_none_match (str, optional): If-None-Match request header
+
+    Returns:
+        tuple: (body, status, headers) usable as a Flask or Quart view return value
+    """
+    stored = result_store.get(result_id)
+    if stored is None:
+        return {"error": "Result not found or expired"}, 404, {}
+    data, mime_type = stored
+    # Results never change once stored, so the id doubles as a strong ETag
+    etag = f'"{result_id}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={int(result_store.ttl)}, immutable",
+    }
+    if if_none_match and etag in if_none_match:
+        return b"", 304, headers
+    headers["Content-Type"] = mime_type
+    return data, 200, headers
+
+
+def parse_headswap_response(response_data):
+    """
+    Extract the output image from a HeadSwapper response body.
+
+    Raises:
+        TryOnError: If the response does not have the expected structure
+    """
+    if response_data.get("status") == "success" and "data" in response_data:
+        output_image = response_data["data"].get("output_image")
+        if output_image:
+            logging.debug("DEBUG: Successfully extracted output image from response")
+            return output_image
+    logging.debug(f"DEBUG: Unexpected response structure: {response_data}")
+    raise TryOnError("Invalid response from HeadSwapper service", 500)
+
+
+def record_headswapper_error(status_code):
+    """
+    Feed a failed HeadSwapper call into the circuit breaker.
+
+    Args:
+        status_code (int): HTTP status of the failed call, None if no response
+    """
+    upstream_errors_total.inc(upstream="headswapper")
+    # A 4xx means the service is up but rejected this payload
+    if status_code is None or status_code >= 500:
+        headswapper_breaker.record_failure()
+
+
+def call_headswapper(payload):
+    """
+    Send a head swap request through the pooled client.
+
+    Returns:
+        str: Output image returned by the HeadSwapper
+
+    Raises:
+        HeadSwapperUnavailable: If the request itself failed
+        TryOnError: If the response could not be used
+    """
+    logging.debug("DEBUG: Sending request to HeadSwapper API...")
+    logging.debug(f"DEBUG: API URL: {headswapper_client.url}")
+    logging.debug(f"DEBUG: Payload keys: {list(payload.keys())}")
+    try:
+        with stage_seconds.time(stage="headswapper"):
+            hs_response = headswapper_hedger.call(headswapper_client.swap, payload)
+        logging.debug(f"HeadSwapper response status: {hs_response.status_code}")
+        logging.debug(f"HeadSwapper response: {hs_response.text[:500]}")  # Print first 500 chars of response
+        hs_response.raise_for_status()
+        response_data = hs_response.json()
+    except requests.exceptions.RequestException as e:
+        logging.error(f"HeadSwapper API error: {str(e)}")
+        record_headswapper_error(e.response.status_code if e.response is not None else None)
+        raise HeadSwapperUnavailable()
+    except Exception as e:
+        logging.error(f"Error processing HeadSwapper response: {str(e)}")
+        raise TryOnError("Failed to process HeadSwapper response", 500)
+
+    output_image = parse_headswap_response(response_data)
+    headswapper_breaker.record_success()
+    return output_image
+
+
+def iter_tryon(image_bytes, image_hash, analysis, reference_image_rel):
+    """
+    Run the try-on pipeline for one user image, yielding each stage as it finishes.
+
+    Args:
+        image_bytes (bytes): User image
+        image_hash (str): Content hash of image_bytes
+        analysis (dict): Analysis of the image, or None to analyze it here
+        reference_image_rel (str): Reference image requested by the frontend,
+            or empty to pick one from the analysis
+
+    Yields:
+        tuple: (stage, data) for the "analysis", "pregenerated" and "result"
+        stages. The result is a dict with output_image, analysis,
+        pregenerated_image_url and, in fallback mode, a warning
+    """
+    # 1. Analyze the user image (resized for analysis)
+    if analysis is None:
+        analysis = analyze_user_image_from_bytes(image_bytes, image_hash)
+    yield "analysis", analysis
+
+    # 2. Get the reference image path (allow override from frontend)
+    ref_path, pregenerated_image_url = resolve_reference_image(reference_image_rel, analysis)
+    yield "pregenerated", {"pregenerated_image_url": pregenerated_image_url}
+
+    # 3. Get the reference image as a base64 data URI
+    with stage_seconds.time(stage="reference_load"):
+        reference_image_data_uri, reference_hash = reference_images.load(ref_path)
+
+    # Repeat try-ons of the same photo and reference skip the HeadSwapper
+    cache_key = headswap_cache_key(image_hash, reference_hash, headswap_parameters(analysis))
+    output_image = headswap_cache.get(cache_key)
+    if output_image is not None:
+        logging.debug(f"DEBUG: Using cached head swap for {image_hash[:12]}")
+        yield "result", {
+            "output_image": output_image,
+            "analysis": analysis,
+            "pregenerated_image_url": pregenerated_image_url,
         }
-        
-        logging.debug("DEBUG: Sending request to HeadSwapper API...")
-        logging.debug(f"DEBUG: Reference image path: {ref_path}")
-        logging.debug(f"DEBUG: Reference image exists: {os.path.exists(ref_path)}")
-        logging.debug(f"DEBUG: Reference image size: {os.path.getsize(ref_path) if os.path.exists(ref_path) else 'N/A'}")
-        logging.debug(f"DEBUG: API URL: {url}")
-        logging.debug(f"DEBUG: Payload keys: {list(payload.keys())}")
-        
-        try:
-            hs_response = requests.post(url, json=payload, timeout=120)
-            logging.debug("DEBUG: HeadSwapper request sent successfully")
-            logging.debug(f"HeadSwapper response status: {hs_response.status_code}")
-            logging.debug(f"HeadSwapper response: {hs_response.text[:500]}")  # Print first 500 chars of response
-            hs_response.raise_for_status()
-            
-            # Parse the new response structure
-            response_data = hs_response.json()
-            if response_data.get("status") == "success" and "data" in response_data:
-                output_image = response_data["data"]["output_image"]
-                logging.debug("DEBUG: Successfully extracted output image from response")
-            else:
-                logging.debug(f"DEBUG: Unexpected response structure: {response_data}")
-                return jsonify({"error": "Invalid response from HeadSwapper service"}), 500
-                
-        except requests.exceptions.RequestException as e:
-            logging.error(f"HeadSwapper API error: {str(e)}")
-            return jsonify({"error": "Failed to connect to HeadSwapper service"}), 503
-        except Exception as e:
-            logging.error(f"Error processing HeadSwapper response: {str(e)}")
-            return jsonify({"error": "Failed to process HeadSwapper response"}), 500
+        return
 
-        return jsonify(
-            {
-                "output_image": output_image,
-                "analysis": analysis,
-                "pregenerated_image_url": pregenerated_image_url,
-            }
+    # The circuit breaker is fed by the background health monitor and by
+    # real call outcomes, so checking it costs no round trip
+    if not headswapper_breaker.allow_request():
+        logging.warning("WARNING: HeadSwapper circuit breaker is open. Using fallback mode.")
+        yield "result", fallback_result(reference_image_data_uri, analysis, pregenerated_image_url)
+        return
+
+    # 4. Call the HeadSwapper API with the normalized image. Identical
+    # concurrent try-ons, from any endpoint, wait for one call and share it
+    try:
+        output_image, shared = headswap_flights.do(
+            cache_key, swap_head, cache_key, image_bytes, analysis, reference_image_data_uri
+        )
+    except HeadSwapperUnavailable:
+        logging.warning("WARNING: HeadSwapper request failed. Using fallback mode.")
+        yield "result", fallback_result(reference_image_data_uri, analysis, pregenerated_image_url)
+        return
+    if shared:
+        logging.debug(f"DEBUG: Joined in-flight head swap for {image_hash[:12]}")
+
+    yield "result", {
+        "output_image": output_image,
+        "analysis": analysis,
+        "pregenerated_image_url": pregenerated_image_url,
+    }
+
+
+def swap_head(cache_key, image_bytes, analysis, reference_image_data_uri):
+    """
+    Call the HeadSwapper and cache its output under cache_key.
+
+    Returns:
+        str: Output image
+    """
+    payload = build_headswap_payload(image_bytes, analysis, reference_image_data_uri)
+    output_image = call_headswapper(payload)
+    headswap_cache.set(cache_key, output_image)
+    return output_image
+
+
+def run_tryon(image_bytes, image_hash, analysis, reference_image_rel):
+    """
+    Run the whole try-on pipeline and return the final result of iter_tryon.
+    """
+    image_hash = image_hash or content_hash(image_bytes)
+    for stage, data in iter_tryon(image_bytes, image_hash, analysis, reference_image_rel):
+        if stage == "result":
+            return data
+
+
+@app.route("/api/swap-head", methods=["POST"])
+@admission_controlled
+def swap_head_api():
+    response_format = request.form.get("response_format", "json")
+    if response_format not in RESPONSE_FORMATS:
+        return jsonify({"error": f"response_format must be one of: {', '.join(RESPONSE_FORMATS)}"}), 400
+
+    try:
+        # A handle from /api/analyze-user-image replaces the image upload
+        original_image_bytes, image_hash, analysis = resolve_upload(
+            request.form.get("upload_id"), request.files.get("image")
+        )
+        result = run_tryon(
+            original_image_bytes, image_hash, analysis, request.form.get("reference_image")
         )
+        with stage_seconds.time(stage="serialization"):
+            body, status, headers = deliver_swap_result(result, response_format)
+            if isinstance(body, dict):
+                body = jsonify(body)
+        return body, status, headers
+    except TryOnError as e:
+        return jsonify({"error": e.message}), e.status_code, e.headers
     except Exception as e:
-        logging.error("Error in swap-head:", e)
+        logging.error(f"Error in swap-head: {e}")
         traceback.print_exc()
         return jsonify({"error": "Internal server error. Please try again."}), 500
 
 
+def sse_event(event, data):
+    """
+    Format one Server-Sent Events message with a JSON payload.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route("/api/swap-head/stream", methods=["POST"])
+@admission_controlled
+def swap_head_stream_api():
+    """
+    Streaming variant of /api/swap-head that reports each stage as a
+    Server-Sent Event: accepted, analysis, pregenerated, then result or error.
+    """
+    response_format = request.form.get("response_format", "json")
+    if response_format not in ("json", "url"):
+        return jsonify({"error": "response_format must be one of: json, url"}), 400
+
+    try:
+        original_image_bytes, image_hash, analysis = resolve_upload(
+            request.form.get("upload_id"), request.files.get("image")
+        )
+    except TryOnError as e:
+        return jsonify({"error": e.message}), e.status_code, e.headers
+    reference_image_rel = request.form.get("reference_image")
+
+    def generate():
+        yield sse_event("accepted", {"status": "accepted"})
+        try:
+            for stage, data in iter_tryon(
+                original_image_bytes, image_hash, analysis, reference_image_rel
+            ):
+                if stage == "result":
+                    data = deliver_swap_result(data, response_format)[0]
+                yield sse_event(stage, data)
+        except TryOnError as e:
+            yield sse_event("error", {"error": e.message, "status_code": e.status_code})
+        except Exception as e:
+            logging.error(f"Error in swap-head stream: {e}")
+            traceback.print_exc()
+            yield sse_event(
+                "error", {"error": "Internal server error. Please try again.", "status_code": 500}
+            )
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def run_tryon_job(image_bytes, image_hash, analysis, reference_image_rel, response_format):
+    result = run_tryon(image_bytes, image_hash, analysis, reference_image_rel)
+    return deliver_swap_result(result, response_format)[0]
+
+
+def tryon_job_error(e):
+    if isinstance(e, TryOnError):
+        return e.message, e.status_code
+    return "Internal server error. Please try again.", 500
+
+
+tryon_jobs = JobQueue(
+    run_tryon_job,
+    workers=server_config.TRYON_JOB_WORKERS,
+    max_depth=server_config.TRYON_JOB_QUEUE_DEPTH,
+    ttl=server_config.TRYON_JOB_TTL,
+    error_handler=tryon_job_error,
+    max_bytes=server_config.TRYON_JOB_MAX_BYTES,
+)
+
+
+@app.route("/api/tryon-jobs", methods=["POST"])
+@admission_controlled(blocking=False)
+def create_tryon_job_api():
+    # Same form fields as /api/swap-head; binary results cannot be polled as JSON
+    response_format = request.form.get("response_format", "json")
+    if response_format not in ("json", "url"):
+        return jsonify({"error": "response_format must be one of: json, url"}), 400
+
+    try:
+        original_image_bytes, image_hash, analysis = resolve_upload(
+            request.form.get("upload_id"), request.files.get("image")
+        )
+        job_id = tryon_jobs.submit(
+            original_image_bytes,
+            image_hash,
+            analysis,
+            request.form.get("reference_image"),
+            response_format,
+        )
+    except TryOnError as e:
+        return jsonify({"error": e.message}), e.status_code, e.headers
+    except QueueFullError:
+        return (
+            jsonify({"error": "Too many try-ons in progress. Please retry shortly."}),
+            503,
+            {"Retry-After": str(server_config.TRYON_JOB_RETRY_AFTER)},
+        )
+
+    return (
+        jsonify({"job_id": job_id, "status": "queued", "status_url": f"/api/tryon-jobs/{job_id}"}),
+        202,
+        {"Location": f"/api/tryon-jobs/{job_id}"},
+    )
+
+
+@app.route("/api/tryon-jobs/<job_id>")
+def get_tryon_job_api(job_id):
+    job = tryon_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found or expired"}), 404
+    return jsonify(job), 200
+
+
+@app.route("/results/<result_id>")
+def serve_result(result_id):
+    return stored_result_response(result_id, request.headers.get("If-None-Match"))
+
+
 @app.route("/images/<path:filename>")
 def serve_images(filename):
     try:
-        # Construct the full path to the frontend/public/images directory
-        images_dir = IMAGES_DIR
-        return send_from_directory(images_dir, filename)
+        image = resolve_image_request(filename, request.args, request.accept_mimetypes)
+        if image is None:
+            return jsonify({"error": "Image not found"}), 404
+        # send_file answers If-None-Match/If-Modified-Since with a 304 and
+        # Range with a 206, and hands files to wsgi.file_wrapper (sendfile)
+        response = send_file(
+            image["path"] or BytesIO(image["data"]),
+            mimetype=image["mimetype"],
+            etag=image["etag"],
+            last_modified=image["mtime"],
+            max_age=image["max_age"],
+        )
+        response.cache_control.public = True
+        if image["immutable"]:
+            response.cache_control.immutable = True
+        if image["vary_accept"]:
+            response.vary.add("Accept")
+        return response
+    except TryOnError as e:
+        return jsonify({"error": e.message}), e.status_code, e.headers
     except Exception as e:
         logging.error(f"Error serving image {filename}: {e}")
         return jsonify({"error": "Image not found"}), 404
 
 
+def warm_caches():
+    """
+    Build the read-only caches and indexes. Under gunicorn with preload_app
+    this runs once in the master and the workers share the result
+    copy-on-write.
+    """
+    if server_config.REFERENCE_CACHE_PRELOAD:
+        reference_images.preload()
+    if server_config.STATIC_INDEX_PRELOAD:
+        static_files.preload()
+
+
+def start_background_services():
+    """
+    Start the HeadSwapper health monitor and the try-on job workers. Threads
+    do not survive fork(), so every serving process calls this itself.
+    """
+    headswapper_health.start()
+    tryon_jobs.start()
+
+
+def create_app(start_services=True):
+    """
+    Application factory used by gunicorn and the development server.
+
+    Args:
+        start_services (bool): Start the background threads as well; pass
+            False when a post-fork hook starts them in each worker
+
+    Returns:
+        Flask: The configured app
+    """
+    configure_logging()
+    if not api_key:
+        logging.warning("OPENAI_API_KEY is not set")
+    logging.info(f"Serving images from {IMAGES_DIR}")
+    warm_caches()
+    if start_services:
+        start_background_services()
+    return app
+
+
 if __name__ == "__main__":
     import sys
 
     if len(sys.argv) == 2:
+        configure_logging()
         with open(sys.argv[1], "rb") as f:
             result = analyze_user_image_from_bytes(f.read())
             print(json.dumps(result, indent=2))
@@ -453,8 +1718,9 @@ if __name__ == "__main__":
             os.getenv("FLASK_ENV") == "production" or os.getenv("VERCEL") == "1"
         )
 
+        create_app()
         if is_production:
-            # Production settings - secure
+            # Production deployments should use gunicorn (see gunicorn.conf.py)
             app.run(debug=False, port=5003, host="127.0.0.1")
         else:
             # Development settings
@@ -0,0 +1,173 @@
+"""
+Upload normalization for the HeadSwapper request.
+
+Phone photos arrive as 12-megapixel JPEGs with an EXIF rotation, or as
+multi-megabyte PNGs, and used to be sent to the HeadSwapper as they were.
+Before the head swap, uploads are turned upright, stripped of metadata,
+converted to sRGB RGB, downsized to a long-edge limit and re-encoded as JPEG
+or WebP. Uploads that are already small, upright, metadata-free JPEGs are
+passed through untouched.
+"""
+import logging
+import math
+import threading
+import time
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from preprocessing import RESAMPLE_FILTERS
+
+try:
+    from PIL import ImageCms
+
+    _SRGB_PROFILE = ImageCms.createProfile("sRGB")
+except ImportError:  # Pillow built without littlecms
+    ImageCms = None
+
+FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+# JPEG info keys that carry metadata worth stripping
+_METADATA_KEYS = ("exif", "icc_profile", "xmp", "photoshop", "comment")
+
+
+class NormalizedImage(bytes):
+    """
+    Output of UploadNormalizer.normalize(). Passing it to normalize() again
+    returns it as is instead of re-encoding it.
+    """
+
+    def __new__(cls, data, mime_type):
+        image = super().__new__(cls, data)
+        image.mime_type = mime_type
+        return image
+
+
+class UploadNormalizer:
+    def __init__(
+        self,
+        max_edge=2048,
+        output_format="jpeg",
+        quality=90,
+        resample="lanczos",
+        passthrough_max_bytes=1024 * 1024,
+    ):
+        """
+        Args:
+            max_edge (int): Long-edge limit in pixels, 0 for no limit
+            output_format (str): "jpeg" or "webp"
+            quality (int): Encoder quality (1-100)
+            resample (str): Resampling filter name from RESAMPLE_FILTERS
+            passthrough_max_bytes (int): Upright, metadata-free JPEGs within
+                max_edge and at most this many bytes are sent as uploaded;
+                0 disables pass-through
+        """
+        self.max_edge = max_edge
+        self.output_format = output_format
+        self.pil_format, self.mime_type = FORMATS[output_format]
+        self.quality = quality
+        self.resample = RESAMPLE_FILTERS[resample]
+        self.passthrough_max_bytes = passthrough_max_bytes
+        # Part of the head swap cache key: other settings give another image
+        self.signature = f"{max_edge}:{output_format}:{quality}:{resample}"
+        self._lock = threading.Lock()
+        self.images = 0
+        self.passthroughs = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def _can_pass_through(self, img, image_bytes):
+        return (
+            self.output_format == "jpeg"
+            and img.format == "JPEG"
+            and img.mode == "RGB"
+            and (not self.max_edge or max(img.size) <= self.max_edge)
+            and len(image_bytes) <= self.passthrough_max_bytes
+            and not any(key in img.info for key in _METADATA_KEYS)
+        )
+
+    def normalize(self, image_bytes):
+        """
+        Normalize an upload for the HeadSwapper.
+
+        Args:
+            image_bytes (bytes): Raw uploaded image
+
+        Returns:
+            tuple: (NormalizedImage, MIME type)
+        """
+        if isinstance(image_bytes, NormalizedImage):
+            return image_bytes, image_bytes.mime_type
+        start = time.perf_counter()
+        img = Image.open(BytesIO(image_bytes))
+        if self._can_pass_through(img, image_bytes):
+            self._record(image_bytes, image_bytes, start, passthrough=True)
+            return NormalizedImage(image_bytes, "image/jpeg"), "image/jpeg"
+
+        width, height = img.size
+        if img.format == "JPEG" and self.max_edge and max(width, height) > self.max_edge:
+            # Decode at 1/2, 1/4 or 1/8 scale where that still covers max_edge
+            scale = self.max_edge / max(width, height)
+            img.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+
+        icc_profile = img.info.get("icc_profile")
+        img = ImageOps.exif_transpose(img)
+        img = self._to_srgb(img, icc_profile)
+        if self.max_edge and max(img.size) > self.max_edge:
+            img.thumbnail((self.max_edge, self.max_edge), self.resample, reducing_gap=2.0)
+
+        buffered = BytesIO()
+        # No exif/icc_profile arguments, so no metadata is written
+        img.save(buffered, format=self.pil_format, quality=self.quality)
+        output = NormalizedImage(buffered.getvalue(), self.mime_type)
+        self._record(image_bytes, output, start, passthrough=False)
+        logging.debug(
+            f"DEBUG: Normalized upload {width}x{height} {len(image_bytes)} bytes -> "
+            f"{img.size[0]}x{img.size[1]} {self.output_format} {len(output)} bytes"
+        )
+        return output, self.mime_type
+
+    def _to_srgb(self, img, icc_profile=None):
+        """
+        Convert to 8-bit RGB in sRGB, flattening transparency onto white.
+        """
+        if img.mode == "P":
+            img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+        if img.mode in ("RGBA", "LA", "PA"):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+
+        if icc_profile and ImageCms is not None:
+            try:
+                # Converts from the embedded profile's colour space (e.g. CMYK
+                # or Display P3) straight to sRGB RGB
+                source = ImageCms.ImageCmsProfile(BytesIO(icc_profile))
+                return ImageCms.profileToProfile(img, source, _SRGB_PROFILE, outputMode="RGB")
+            except (ImageCms.PyCMSError, OSError, ValueError) as e:
+                logging.debug(f"DEBUG: Ignoring unusable ICC profile: {e}")
+        return img if img.mode == "RGB" else img.convert("RGB")
+
+    def _record(self, image_bytes, output, start, passthrough):
+        with self._lock:
+            self.images += 1
+            self.passthroughs += passthrough
+            self.bytes_in += len(image_bytes)
+            self.bytes_out += len(output)
+            self.seconds += time.perf_counter() - start
+
+    def stats(self):
+        return {
+            "max_edge": self.max_edge,
+            "format": self.output_format,
+            "images": self.images,
+            "passthroughs": self.passthroughs,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "avg_ms": self.seconds / self.images * 1000 if self.images else 0.0,
+        }
@@ -0,0 +1,361 @@
+"""
+Process-wide concurrency governor for OpenAI calls.
+
+Every OpenAI call in the process (the analysis in main.py and the image
+generation/editing in image_gen) goes through one of two budgets, "chat" and
+"image". Each budget adapts its in-flight limit with AIMD: the limit grows by
+one per limit-many successful calls and is halved on a 429. A 429 also pauses
+the whole budget for the retry-after period, so one throttled call holds back
+every caller instead of each retrying on its own schedule.
+
+The SDK clients are created with max_retries=0 so that retries go through
+the governor: a throttled call is retried once the pause is over, and 5xx
+and connection errors are retried with exponential backoff, up to
+max_attempts and within the caller's timeout.
+"""
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from openai import APIConnectionError, APIStatusError
+
+import server_config
+
+# How often acall() re-checks for a free slot while waiting
+ASYNC_POLL_INTERVAL = 0.05
+
+
+class GovernorTimeout(Exception):
+    """Raised when no call slot frees up within the acquire timeout."""
+
+
+def retry_after_seconds(error):
+    """
+    Read the retry-after hint from an OpenAI error.
+
+    Returns:
+        float: Seconds to wait, or None if the response carries no hint
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None) or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def call_outcome(error):
+    """
+    Classify an exception raised by an OpenAI call.
+
+    Returns:
+        tuple: ("throttled", retry-after seconds or None) for a 429,
+        otherwise ("error", None)
+    """
+    if isinstance(error, APIStatusError) and error.status_code == 429:
+        return "throttled", retry_after_seconds(error)
+    return "error", None
+
+
+def is_transient(error):
+    """
+    Whether an OpenAI error is worth retrying: a 5xx response, a dropped
+    connection or a timeout.
+    """
+    if isinstance(error, APIStatusError):
+        return error.status_code >= 500
+    return isinstance(error, APIConnectionError)
+
+
+class AIMDLimiter:
+    def __init__(
+        self,
+        name,
+        initial=4,
+        minimum=1,
+        maximum=32,
+        decrease_factor=0.5,
+        base_pause=2,
+        max_pause=60,
+    ):
+        """
+        Args:
+            name (str): Budget name used in logs and stats
+            initial (int): Starting in-flight limit
+            minimum (int): Lowest limit a run of throttles can drive it to
+            maximum (int): Highest limit successes can raise it to
+            decrease_factor (float): Multiplier applied to the limit on a throttle
+            base_pause (float): Pause after a throttle without a retry-after
+                hint; doubles with each consecutive throttle
+            max_pause (float): Upper bound for pauses without a hint
+        """
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.base_pause = base_pause
+        self.max_pause = max_pause
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._consecutive_throttles = 0
+        # Calls started before the last decrease belong to the old window and
+        # must not trigger another one
+        self._epoch = 0
+        self.calls = 0
+        self.throttles = 0
+        self.errors = 0
+
+    def pause_remaining(self):
+        """
+        Returns:
+            float: Seconds until the budget resumes after a throttle, 0 if not paused
+        """
+        return max(0.0, self._paused_until - time.monotonic())
+
+    def acquire(self, timeout=None):
+        """
+        Wait for a free call slot.
+
+        Args:
+            timeout (float, optional): Seconds to wait, None to wait indefinitely
+
+        Returns:
+            int: Epoch token to pass back to release()
+
+        Raises:
+            GovernorTimeout: If no slot frees up in time
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                paused_for = self._paused_until - now
+                if paused_for <= 0 and self._in_flight < int(self.limit):
+                    return self._take_slot()
+                wait = paused_for if paused_for > 0 else None
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise GovernorTimeout(f"No {self.name} call slot within {timeout}s")
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._condition.wait(wait)
+
+    def try_acquire(self):
+        """
+        Take a call slot only if one is free right now.
+
+        Returns:
+            int: Epoch token to pass back to release(), or None if the budget
+            is paused or full
+        """
+        with self._condition:
+            if self._paused_until > time.monotonic() or self._in_flight >= int(self.limit):
+                return None
+            return self._take_slot()
+
+    def _take_slot(self):
+        self._in_flight += 1
+        self.calls += 1
+        return self._epoch
+
+    def release(self, epoch, outcome, retry_after=None):
+        """
+        Return a call slot and adapt the limit to the call's outcome.
+
+        Args:
+            epoch (int): Token returned by acquire()
+            outcome (str): "success", "throttled" or "error"
+            retry_after (float, optional): Server retry-after hint for throttles
+        """
+        with self._condition:
+            self._in_flight -= 1
+            if outcome == "success":
+                self._consecutive_throttles = 0
+                # Additive increase: about +1 per limit-many successes
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif outcome == "throttled":
+                self.throttles += 1
+                self._consecutive_throttles += 1
+                if retry_after is None:
+                    retry_after = min(
+                        self.max_pause, self.base_pause * 2 ** (self._consecutive_throttles - 1)
+                    )
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                if epoch == self._epoch:
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self._epoch += 1
+                    logging.warning(
+                        f"OpenAI {self.name} budget throttled: limit {self.limit:.1f}, "
+                        f"pausing {retry_after:.1f}s"
+                    )
+            else:
+                self.errors += 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, timeout=None):
+        """
+        Hold a call slot for the duration of a with block and classify the
+        block's exception (if any) as the call outcome.
+        """
+        epoch = self.acquire(timeout)
+        try:
+            yield
+        except BaseException as e:
+            self.release(epoch, *call_outcome(e))
+            raise
+        self.release(epoch, "success")
+
+    def stats(self):
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self._in_flight,
+            "paused_for": round(self.pause_remaining(), 2),
+            "calls": self.calls,
+            "throttles": self.throttles,
+            "errors": self.errors,
+        }
+
+
+class OpenAIGovernor:
+    def __init__(self, chat, image, max_attempts=3, base_backoff=0.5, max_backoff=8):
+        """
+        Args:
+            chat (AIMDLimiter): Budget for chat completions (image analysis)
+            image (AIMDLimiter): Budget for image generation and editing
+            max_attempts (int): Attempts per call, including the first
+            base_backoff (float): Wait before retrying a 5xx or connection
+                error; doubles with each attempt
+            max_backoff (float): Upper bound for that wait
+        """
+        self.chat = chat
+        self.image = image
+        self.budgets = {"chat": chat, "image": image}
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.retries = 0
+
+    def _retry_wait(self, limiter, error, attempt, deadline):
+        """
+        Seconds to wait before retrying a failed call, or None to give up:
+        on the last attempt, for errors that are not worth retrying, or when
+        the wait would run past the deadline.
+        """
+        if attempt >= self.max_attempts:
+            return None
+        if call_outcome(error)[0] == "throttled":
+            # release() has paused the budget for the retry-after period
+            wait = limiter.pause_remaining()
+        elif is_transient(error):
+            wait = min(self.max_backoff, self.base_backoff * 2 ** (attempt - 1))
+        else:
+            return None
+        if deadline is not None and time.monotonic() + wait >= deadline:
+            return None
+        self.retries += 1
+        logging.warning(
+            f"OpenAI {limiter.name} call failed ({error}), retrying in {wait:.1f}s "
+            f"(attempt {attempt + 1}/{self.max_attempts})"
+        )
+        return wait
+
+    def call(self, budget, fn, *args, timeout=None, **kwargs):
+        """
+        Run fn(*args, **kwargs) within a budget, retrying throttles and
+        transient errors.
+
+        Args:
+            budget (str): "chat" or "image"
+            fn (callable): OpenAI SDK method
+            timeout (float, optional): Seconds to wait for a slot, across
+                all attempts
+
+        Raises:
+            GovernorTimeout: If no slot frees up in time for the first attempt
+            Exception: The last attempt's error
+        """
+        limiter = self.budgets[budget]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        attempt = 1
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            epoch = limiter.acquire(remaining)
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                limiter.release(epoch, *call_outcome(e))
+                wait = self._retry_wait(limiter, e, attempt, deadline)
+                if wait is None:
+                    raise
+                time.sleep(wait)
+                attempt += 1
+                continue
+            limiter.release(epoch, "success")
+            return result
+
+    async def _acquire_async(self, limiter, deadline, timeout):
+        # Polls the budget with asyncio.sleep, so waiters do not hold threads
+        loop = asyncio.get_running_loop()
+        while (epoch := limiter.try_acquire()) is None:
+            # Sleep through a throttle pause in one go, poll otherwise
+            wait = max(limiter.pause_remaining(), ASYNC_POLL_INTERVAL)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise GovernorTimeout(f"No {limiter.name} call slot within {timeout}s")
+                wait = min(wait, remaining)
+            await asyncio.sleep(wait)
+        return epoch
+
+    async def acall(self, budget, fn, *args, timeout=None, **kwargs):
+        """
+        Async version of call() for AsyncOpenAI methods.
+        """
+        limiter = self.budgets[budget]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        attempt = 1
+        while True:
+            epoch = await self._acquire_async(limiter, deadline, timeout)
+            try:
+                result = await fn(*args, **kwargs)
+            except BaseException as e:
+                limiter.release(epoch, *call_outcome(e))
+                wait = self._retry_wait(limiter, e, attempt, deadline)
+                if wait is None:
+                    raise
+                await asyncio.sleep(wait)
+                attempt += 1
+                continue
+            limiter.release(epoch, "success")
+            return result
+
+    def stats(self):
+        return {
+            **{name: limiter.stats() for name, limiter in self.budgets.items()},
+            "retries": self.retries,
+        }
+
+
+# Shared by every OpenAI caller in the process
+openai_governor = OpenAIGovernor(
+    chat=AIMDLimiter(
+        "chat",
+        initial=server_config.OPENAI_CHAT_CONCURRENCY,
+        maximum=server_config.OPENAI_CHAT_MAX_CONCURRENCY,
+    ),
+    image=AIMDLimiter(
+        "image",
+        initial=server_config.OPENAI_IMAGE_CONCURRENCY,
+        maximum=server_config.OPENAI_IMAGE_MAX_CONCURRENCY,
+    ),
+    max_attempts=server_config.OPENAI_MAX_ATTEMPTS,
+)
@@ -0,0 +1,203 @@
+"""
+Perceptual hashes for spotting near-duplicate uploads.
+
+Re-saved, slightly cropped or recompressed copies of a photo have different
+bytes but nearly the same perceptual hash. Hashes are 64-bit integers
+compared by Hamming distance:
+
+    dhash - sign of the horizontal gradient of a 9x8 grayscale thumbnail;
+            cheapest, and holds up well to small crops
+    phash - sign of the low-frequency DCT coefficients of a 32x32 thumbnail
+            relative to their median; steadier under heavy recompression
+            but drifts more when the frame is cropped
+
+Both hashes are grayscale, so two people photographed in the same pose can
+hash alike. colour_signature() gives a coarse colour thumbnail to check
+a match against before trusting it.
+"""
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+HASH_BITS = 64
+
+# Orthonormal DCT-II basis for the 32x32 pHash thumbnail
+_PHASH_SIZE = 32
+_PHASH_LOW = 8
+_n = np.arange(_PHASH_SIZE)
+_DCT = np.cos(np.pi / _PHASH_SIZE * (_n[None, :] + 0.5) * _n[:, None]) * np.sqrt(2 / _PHASH_SIZE)
+_DCT[0] /= np.sqrt(2)
+del _n
+
+
+def _grayscale_thumbnail(image_bytes, size):
+    img = Image.open(BytesIO(image_bytes))
+    if img.format == "JPEG":
+        # Decode at reduced size; the hash only needs a few dozen pixels
+        img.draft("L", (size[0] * 4, size[1] * 4))
+    img = img.convert("L").resize(size, Image.Resampling.BILINEAR)
+    return np.asarray(img, dtype=np.float64)
+
+
+def _pack_bits(bits):
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def dhash(image_bytes):
+    """
+    Difference hash of an encoded image.
+
+    Returns:
+        int: 64-bit hash
+    """
+    pixels = _grayscale_thumbnail(image_bytes, (9, 8))
+    return _pack_bits(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(image_bytes):
+    """
+    DCT hash of an encoded image.
+
+    Returns:
+        int: 64-bit hash
+    """
+    pixels = _grayscale_thumbnail(image_bytes, (_PHASH_SIZE, _PHASH_SIZE))
+    coefficients = (_DCT @ pixels @ _DCT.T)[:_PHASH_LOW, :_PHASH_LOW]
+    # The DC term only reflects overall brightness; leave it out of the median
+    median = np.median(coefficients.ravel()[1:])
+    return _pack_bits(coefficients > median)
+
+
+ALGORITHMS = {"dhash": dhash, "phash": phash}
+
+# Edge of the colour_signature() thumbnail
+_COLOUR_SIZE = 8
+
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+
+def colour_signature(image_bytes):
+    """
+    Coarse colour thumbnail of an encoded image.
+
+    Returns:
+        bytes: 8x8 RGB pixels, compared with colour_distance()
+    """
+    img = Image.open(BytesIO(image_bytes))
+    if img.format == "JPEG":
+        img.draft("RGB", (_COLOUR_SIZE * 4, _COLOUR_SIZE * 4))
+    img = img.convert("RGB").resize((_COLOUR_SIZE, _COLOUR_SIZE), Image.Resampling.BILINEAR)
+    return img.tobytes()
+
+
+def colour_distance(a, b):
+    """
+    Mean absolute difference of two colour signatures, 0-255.
+    """
+    a = np.frombuffer(a, dtype=np.uint8).astype(np.int16)
+    b = np.frombuffer(b, dtype=np.uint8).astype(np.int16)
+    return float(np.mean(np.abs(a - b)))
+
+
+class PerceptualHashIndex:
+    """
+    Bounded LRU index from perceptual hashes to keys, searchable by Hamming
+    distance.
+
+    Lookups use multi-index hashing: the 64 bits are split into
+    max_distance + 1 bands, and any hash within max_distance of a query
+    matches it exactly in at least one band. Only entries sharing a band
+    with the query are compared bit by bit.
+    """
+
+    def __init__(self, max_distance=8, max_entries=4096):
+        """
+        Args:
+            max_distance (int): Largest Hamming distance counted as a match
+            max_entries (int): Number of hashes kept before the least recently
+                used one is dropped
+        """
+        if not 0 <= max_distance < HASH_BITS:
+            raise ValueError(f"max_distance must be between 0 and {HASH_BITS - 1}")
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        band_count = max_distance + 1
+        edges = [HASH_BITS * i // band_count for i in range(band_count + 1)]
+        self._bands = [(start, (1 << (end - start)) - 1) for start, end in zip(edges, edges[1:])]
+        self._entries = OrderedDict()  # hash -> key
+        self._buckets = [{} for _ in self._bands]  # band value -> set of hashes
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        # Matches per Hamming distance, for tuning max_distance
+        self.distances = [0] * (max_distance + 1)
+
+    def _band_values(self, value):
+        return [(value >> start) & mask for start, mask in self._bands]
+
+    def find(self, value, accept=None):
+        """
+        Find the closest indexed hash within max_distance.
+
+        Args:
+            value (int): Hash to look up
+            accept (callable, optional): Called with the key of each candidate
+                within max_distance; candidates it returns False for are skipped
+
+        Returns:
+            tuple: (key, distance), or None if nothing is close enough
+        """
+        with self._lock:
+            self.lookups += 1
+            candidates = set()
+            for bucket, band_value in zip(self._buckets, self._band_values(value)):
+                candidates.update(bucket.get(band_value, ()))
+            best = None
+            for candidate in candidates:
+                distance = hamming_distance(value, candidate)
+                if distance > self.max_distance or (best is not None and distance >= best[1]):
+                    continue
+                if accept is None or accept(self._entries[candidate]):
+                    best = (candidate, distance)
+            if best is None:
+                return None
+            self._entries.move_to_end(best[0])
+            self.hits += 1
+            self.distances[best[1]] += 1
+            return self._entries[best[0]], best[1]
+
+    def add(self, value, key):
+        with self._lock:
+            if value in self._entries:
+                self._entries[value] = key
+                self._entries.move_to_end(value)
+                return
+            self._entries[value] = key
+            for bucket, band_value in zip(self._buckets, self._band_values(value)):
+                bucket.setdefault(band_value, set()).add(value)
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                for bucket, band_value in zip(self._buckets, self._band_values(evicted)):
+                    members = bucket[band_value]
+                    members.discard(evicted)
+                    if not members:
+                        del bucket[band_value]
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "max_distance": self.max_distance,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.lookups, 3) if self.lookups else 0.0,
+            "hits_by_distance": self.distances,
+        }
@@ -0,0 +1,154 @@
+"""
+Image preprocessing for the analysis request.
+
+The vision model only looks at a downscaled version of the image, so uploads
+are decoded at reduced size where the format allows it (JPEG draft mode scales
+in the DCT domain), resized with a cheap filter and re-encoded once. Small
+JPEGs that already fit are passed through untouched.
+"""
+import base64
+import logging
+import math
+import threading
+import time
+from io import BytesIO
+
+from PIL import Image
+
+# Long-edge limits selectable through ANALYSIS_RESOLUTION
+TARGET_RESOLUTIONS = {
+    "low": 512,
+    "standard": 1024,
+    "high": 2000,
+}
+
+RESAMPLE_FILTERS = {
+    "nearest": Image.Resampling.NEAREST,
+    "bilinear": Image.Resampling.BILINEAR,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+
+STAGES = ("decode", "resize", "encode", "base64")
+
+
+class ImagePreprocessor:
+    def __init__(
+        self,
+        max_edge=1024,
+        resample="bilinear",
+        quality=85,
+        passthrough_max_bytes=1024 * 1024,
+        draft=True,
+    ):
+        """
+        Args:
+            max_edge (int or str): Long-edge limit in pixels, or a key of
+                TARGET_RESOLUTIONS
+            resample (str): Resampling filter name from RESAMPLE_FILTERS
+            quality (int): JPEG quality used when re-encoding (1-100)
+            passthrough_max_bytes (int): JPEGs within max_edge and at most this
+                many bytes are sent as uploaded; 0 disables pass-through
+            draft (bool): Use JPEG draft mode to decode at reduced size
+        """
+        if isinstance(max_edge, str):
+            max_edge = int(max_edge) if max_edge.isdigit() else TARGET_RESOLUTIONS[max_edge]
+        self.max_edge = max_edge
+        self.resample = RESAMPLE_FILTERS[resample]
+        self.quality = quality
+        self.passthrough_max_bytes = passthrough_max_bytes
+        self.draft = draft
+        # Part of the analysis cache key: other settings give another image
+        self.signature = f"{max_edge}:{resample}:{quality}:{passthrough_max_bytes}:{draft}"
+        self._lock = threading.Lock()
+        self.images = 0
+        self.passthroughs = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.stage_seconds = dict.fromkeys(STAGES, 0.0)
+
+    def prepare(self, image_bytes):
+        """
+        Turn an upload into the base64 JPEG sent to the vision model.
+
+        Args:
+            image_bytes (bytes): Raw uploaded image
+
+        Returns:
+            dict: base64 (str), width and height (int), passthrough (bool)
+            and timings (dict of stage name to seconds)
+        """
+        timings = dict.fromkeys(STAGES, 0.0)
+
+        start = time.perf_counter()
+        img = Image.open(BytesIO(image_bytes))
+        width, height = img.size
+        passthrough = (
+            img.format == "JPEG"
+            and img.mode in ("RGB", "L")
+            and max(width, height) <= self.max_edge
+            and len(image_bytes) <= self.passthrough_max_bytes
+        )
+        if passthrough:
+            jpeg_bytes = image_bytes
+        else:
+            if self.draft and img.format == "JPEG" and max(width, height) > self.max_edge:
+                # Let libjpeg scale by 1/2, 1/4 or 1/8 while decoding, never
+                # below the size the resize step needs
+                scale = self.max_edge / max(width, height)
+                img.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+            img.load()
+        timings["decode"] = time.perf_counter() - start
+
+        if not passthrough:
+            start = time.perf_counter()
+            if max(img.size) > self.max_edge:
+                img.thumbnail((self.max_edge, self.max_edge), self.resample, reducing_gap=2.0)
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            width, height = img.size
+            timings["resize"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            buffered = BytesIO()
+            img.save(buffered, format="JPEG", quality=self.quality)
+            jpeg_bytes = buffered.getvalue()
+            timings["encode"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        img_base64 = base64.b64encode(jpeg_bytes).decode()
+        timings["base64"] = time.perf_counter() - start
+
+        with self._lock:
+            self.images += 1
+            self.passthroughs += passthrough
+            self.bytes_in += len(image_bytes)
+            self.bytes_out += len(jpeg_bytes)
+            for stage, seconds in timings.items():
+                self.stage_seconds[stage] += seconds
+
+        logging.debug(
+            f"DEBUG: Preprocessed {len(image_bytes)} -> {len(jpeg_bytes)} bytes, "
+            f"{width}x{height}, passthrough={passthrough}, "
+            + ", ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in timings.items())
+        )
+        return {
+            "base64": img_base64,
+            "width": width,
+            "height": height,
+            "passthrough": passthrough,
+            "timings": timings,
+        }
+
+    def stats(self):
+        return {
+            "max_edge": self.max_edge,
+            "images": self.images,
+            "passthroughs": self.passthroughs,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "avg_stage_ms": {
+                stage: (seconds / self.images * 1000 if self.images else 0.0)
+                for stage, seconds in self.stage_seconds.items()
+            },
+        }
@@ -0,0 +1,115 @@
+"""
+In-memory cache of reference images encoded as data URIs.
+
+There are only a few dozen reference images, so each one is read and base64
+encoded once and then served from memory on every try-on.
+"""
+import base64
+import logging
+import os
+import threading
+import time
+
+from caching import content_hash
+
+
+def _load_image_file(path):
+    with open(path, "rb") as img_file:
+        data = img_file.read()
+    ext = path.split(".")[-1]
+    return f"data:image/{ext};base64,{base64.b64encode(data).decode()}", content_hash(data)
+
+
+class ReferenceImageCache:
+    def __init__(self, root, extensions=(".png", ".jpg", ".jpeg", ".webp"), revalidate_interval=5):
+        """
+        Args:
+            root (str): Directory holding the reference images
+            extensions (tuple): File extensions picked up by preload()
+            revalidate_interval (float): Minimum seconds between mtime/size
+                checks of a cached file; 0 checks on every lookup
+        """
+        self.root = root
+        self.extensions = extensions
+        self.revalidate_interval = revalidate_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def preload(self):
+        """
+        Encode every reference image under the root directory.
+
+        Returns:
+            int: Number of images loaded
+        """
+        count = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.lower().endswith(self.extensions):
+                    self.data_uri(os.path.join(dirpath, filename))
+                    count += 1
+        logging.info(
+            f"Preloaded {count} reference images ({self.memory_bytes() // 1024} KiB)"
+        )
+        return count
+
+    def data_uri(self, path):
+        """
+        Get a reference image as a data URI, loading it on first use.
+
+        Args:
+            path (str): Path to the image file
+
+        Returns:
+            str: data:image/<ext>;base64,... URI
+        """
+        return self.load(path)[0]
+
+    def load(self, path):
+        """
+        Get a reference image as a data URI together with the SHA-256 of the
+        file, loading it on first use.
+
+        Args:
+            path (str): Path to the image file
+
+        Returns:
+            tuple: (data URI, hex digest of the file contents)
+        """
+        path = os.path.abspath(path)
+        now = time.monotonic()
+        entry = self._entries.get(path)
+        if entry is not None:
+            data_uri, digest, signature, checked_at = entry
+            if now - checked_at < self.revalidate_interval:
+                self.hits += 1
+                return data_uri, digest
+            stat = os.stat(path)
+            if (stat.st_mtime_ns, stat.st_size) == signature:
+                self._entries[path] = (data_uri, digest, signature, now)
+                self.hits += 1
+                return data_uri, digest
+            self.reloads += 1
+        else:
+            self.misses += 1
+
+        stat = os.stat(path)
+        data_uri, digest = _load_image_file(path)
+        with self._lock:
+            self._entries[path] = (data_uri, digest, (stat.st_mtime_ns, stat.st_size), now)
+        return data_uri, digest
+
+    def memory_bytes(self):
+        return sum(len(entry[0]) for entry in list(self._entries.values()))
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "memory_bytes": self.memory_bytes(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "reloads": self.reloads,
+        }
@@ -0,0 +1,69 @@
+"""
+Short-lived store for head swap results.
+
+Lets /api/swap-head hand out a URL for the output image instead of inlining
+a multi-megabyte base64 data URI in the JSON response.
+"""
+import base64
+import binascii
+import secrets
+
+from caching import TTLCache
+
+
+def decode_data_uri(data_uri):
+    """
+    Split a base64 data URI into its MIME type and raw bytes.
+
+    Args:
+        data_uri (str): data:<mime>;base64,<payload>
+
+    Returns:
+        tuple: (mime_type, bytes), or None if the value is not a base64 data URI
+    """
+    if not data_uri or not data_uri.startswith("data:"):
+        return None
+    header, _, payload = data_uri.partition(",")
+    if not header.endswith(";base64"):
+        return None
+    mime_type = header[len("data:"):-len(";base64")] or "application/octet-stream"
+    try:
+        return mime_type, base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+
+class ResultStore:
+    def __init__(self, max_entries=128, ttl=600, max_bytes=None):
+        """
+        Args:
+            max_entries (int): Maximum number of stored results
+            ttl (float): Seconds a result can be fetched after it was stored
+            max_bytes (int, optional): Total image bytes kept before the oldest
+                results are dropped, None for no limit
+        """
+        self.ttl = ttl
+        self._results = TTLCache(
+            max_entries=max_entries,
+            ttl=ttl,
+            max_bytes=max_bytes,
+            size=lambda result: len(result[0]),
+        )
+
+    def put(self, data, mime_type):
+        """
+        Store an image and return its id.
+        """
+        result_id = secrets.token_urlsafe(24)
+        self._results.set(result_id, (data, mime_type))
+        return result_id
+
+    def get(self, result_id):
+        """
+        Returns:
+            tuple: (bytes, mime_type), or None if unknown or expired
+        """
+        return self._results.get(result_id)
+
+    def stats(self):
+        return self._results.stats()
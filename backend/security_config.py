@@ -94,7 +94,7 @@ def validate_path_within_base(file_path, base_path):
         return False
 
 
-# Rate limiting settings (for future implementation)
+# Per-client rate limit on the analysis and try-on endpoints (see admission.py)
 RATE_LIMIT_REQUESTS = 10  # requests per minute
 RATE_LIMIT_WINDOW = 60  # seconds
 
@@ -0,0 +1,191 @@
+"""
+Runtime settings for the try-on API server.
+
+Every value can be overridden with an environment variable of the same name.
+"""
+import os
+import tempfile
+
+from dotenv import load_dotenv
+
+# Settings are read at import time, so pick up .env before anything else
+load_dotenv()
+
+
+def _env_int(name, default):
+    value = os.getenv(name, "").strip()
+    return int(value) if value else default
+
+
+def _env_float(name, default):
+    value = os.getenv(name, "").strip()
+    return float(value) if value else default
+
+
+def _env_str(name, default=""):
+    return os.getenv(name, default).strip()
+
+
+# Root log level; DEBUG also logs request details
+LOG_LEVEL = _env_str("LOG_LEVEL", "INFO").upper()
+
+# /api/stats shows internals (upstream URLs, cache directories, breaker
+# state) and answers only requests with "Authorization: Bearer <STATS_TOKEN>";
+# left empty, the endpoint is disabled
+STATS_TOKEN = _env_str("STATS_TOKEN")
+
+# Analysis cache (keyed by the upload and the analysis settings, see
+# main.analysis_cache_key())
+ANALYSIS_CACHE_MAX_ENTRIES = _env_int("ANALYSIS_CACHE_MAX_ENTRIES", 512)
+ANALYSIS_CACHE_TTL = _env_float("ANALYSIS_CACHE_TTL", 24 * 60 * 60)  # seconds
+# Leave empty to keep the cache in memory only
+ANALYSIS_CACHE_DIR = _env_str("ANALYSIS_CACHE_DIR")
+
+# Near-duplicate uploads (perceptual_hash.py) reuse a cached analysis when
+# their hashes differ in at most ANALYSIS_DEDUP_MAX_DISTANCE of 64 bits and
+# their colour signatures by at most ANALYSIS_DEDUP_MAX_COLOUR_DISTANCE (mean
+# per-channel difference, 0-255). The hashes are grayscale, so different
+# people in the same pose can match at larger distances; keep it at 0-2.
+# A negative distance (the default) disables the lookup. Hit rates are in
+# /api/stats
+ANALYSIS_DEDUP_ALGORITHM = _env_str("ANALYSIS_DEDUP_ALGORITHM", "dhash").lower()
+ANALYSIS_DEDUP_MAX_DISTANCE = _env_int("ANALYSIS_DEDUP_MAX_DISTANCE", -1)
+ANALYSIS_DEDUP_MAX_COLOUR_DISTANCE = _env_float("ANALYSIS_DEDUP_MAX_COLOUR_DISTANCE", 6)
+ANALYSIS_DEDUP_MAX_ENTRIES = _env_int("ANALYSIS_DEDUP_MAX_ENTRIES", 4096)
+
+# Analysis preprocessing: "low", "standard", "high" (see preprocessing.TARGET_RESOLUTIONS)
+# or a long-edge limit in pixels
+ANALYSIS_RESOLUTION = _env_str("ANALYSIS_RESOLUTION", "standard")
+ANALYSIS_RESAMPLE = _env_str("ANALYSIS_RESAMPLE", "bilinear")
+ANALYSIS_JPEG_QUALITY = _env_int("ANALYSIS_JPEG_QUALITY", 85)
+# JPEGs already within the target resolution and this size are sent unchanged
+ANALYSIS_PASSTHROUGH_MAX_BYTES = _env_int("ANALYSIS_PASSTHROUGH_MAX_BYTES", 1024 * 1024)
+
+# Local ITA skin-tone estimate (skin_tone.py) next to the model's skin_color:
+#   off     - not computed
+#   check   - reported as skin_tone_estimate and counted in /metrics
+#   fill    - also replaces a skin_color outside the four buckets
+#   prefer  - also replaces the model's skin_color when confident
+SKIN_TONE_MODE = _env_str("SKIN_TONE_MODE", "check").lower()
+SKIN_TONE_MIN_CONFIDENCE = _env_float("SKIN_TONE_MIN_CONFIDENCE", 0.6)
+
+# Crop uploads to the detected person (subject_crop.py, needs OpenCV) before
+# the analysis (full-person box) and the HeadSwapper (head and shoulders);
+# without a detected face the full frame is sent
+SUBJECT_CROP_ANALYSIS = _env_str("SUBJECT_CROP_ANALYSIS", "false").lower() == "true"
+SUBJECT_CROP_HEADSWAP = _env_str("SUBJECT_CROP_HEADSWAP", "false").lower() == "true"
+SUBJECT_CROP_DETECT_EDGE = _env_int("SUBJECT_CROP_DETECT_EDGE", 640)
+SUBJECT_CROP_MIN_FACE = _env_float("SUBJECT_CROP_MIN_FACE", 0.05)  # fraction of the short edge
+
+# /api/analyze-batch
+ANALYSIS_BATCH_MAX_ITEMS = _env_int("ANALYSIS_BATCH_MAX_ITEMS", 32)
+# Images a client may have analyzed through batches per
+# security_config.RATE_LIMIT_WINDOW, on top of the one request each batch
+# takes from the regular rate limit
+ANALYSIS_BATCH_RATE_LIMIT = _env_int("ANALYSIS_BATCH_RATE_LIMIT", 96)
+ANALYSIS_BATCH_MAX_BYTES = _env_int("ANALYSIS_BATCH_MAX_BYTES", 100 * 1024 * 1024)
+# Images analyzed at once across all batch requests in the process
+ANALYSIS_BATCH_CONCURRENCY = _env_int("ANALYSIS_BATCH_CONCURRENCY", 8)
+
+# Upload sessions returned by /api/analyze-user-image for reuse by /api/swap-head
+UPLOAD_SESSION_MAX_ENTRIES = _env_int("UPLOAD_SESSION_MAX_ENTRIES", 128)
+UPLOAD_SESSION_TTL = _env_float("UPLOAD_SESSION_TTL", 15 * 60)  # seconds
+UPLOAD_SESSION_MAX_BYTES = _env_int("UPLOAD_SESSION_MAX_BYTES", 128 * 1024 * 1024)
+
+# HeadSwapper service
+HEADSWAPPER_URL = _env_str("HEADSWAPPER_URL", "http://34.122.243.90:8090/headswap")
+HEADSWAPPER_HEALTH_INTERVAL = _env_float("HEADSWAPPER_HEALTH_INTERVAL", 15)  # seconds, 0 disables
+HEADSWAPPER_FAILURE_THRESHOLD = _env_int("HEADSWAPPER_FAILURE_THRESHOLD", 3)
+HEADSWAPPER_RESET_TIMEOUT = _env_float("HEADSWAPPER_RESET_TIMEOUT", 30)  # seconds
+HEADSWAPPER_POOL_SIZE = _env_int("HEADSWAPPER_POOL_SIZE", 20)
+HEADSWAPPER_CONNECT_TIMEOUT = _env_float("HEADSWAPPER_CONNECT_TIMEOUT", 5)  # seconds
+HEADSWAPPER_READ_TIMEOUT = _env_float("HEADSWAPPER_READ_TIMEOUT", 120)  # seconds
+HEADSWAPPER_MAX_RETRIES = _env_int("HEADSWAPPER_MAX_RETRIES", 2)
+# Hedging: send a duplicate request once a call is slower than this percentile
+# of recent latencies (0 disables); HEDGE_BUDGET is the extra load allowed
+HEADSWAPPER_HEDGE_PERCENTILE = _env_float("HEADSWAPPER_HEDGE_PERCENTILE", 0)
+HEADSWAPPER_HEDGE_BUDGET = _env_float("HEADSWAPPER_HEDGE_BUDGET", 0.1)
+HEADSWAPPER_HEDGE_MIN_SAMPLES = _env_int("HEADSWAPPER_HEDGE_MIN_SAMPLES", 20)
+HEADSWAPPER_HEDGE_MIN_DELAY = _env_float("HEADSWAPPER_HEDGE_MIN_DELAY", 2)  # seconds
+
+# Upload normalization before the HeadSwapper (normalization.py): upright,
+# no metadata, sRGB, long edge at most HEADSWAP_MAX_EDGE (0 for no limit)
+HEADSWAP_NORMALIZE = _env_str("HEADSWAP_NORMALIZE", "true").lower() == "true"
+HEADSWAP_MAX_EDGE = _env_int("HEADSWAP_MAX_EDGE", 2048)
+HEADSWAP_IMAGE_FORMAT = _env_str("HEADSWAP_IMAGE_FORMAT", "jpeg").lower()  # jpeg or webp
+HEADSWAP_IMAGE_QUALITY = _env_int("HEADSWAP_IMAGE_QUALITY", 90)
+HEADSWAP_RESAMPLE = _env_str("HEADSWAP_RESAMPLE", "lanczos")
+# Upright, metadata-free JPEGs within the limits and this size are sent unchanged
+HEADSWAP_PASSTHROUGH_MAX_BYTES = _env_int("HEADSWAP_PASSTHROUGH_MAX_BYTES", 1024 * 1024)
+
+# Head swap results keyed by upload, reference image and swap parameters
+HEADSWAP_CACHE_MAX_ENTRIES = _env_int("HEADSWAP_CACHE_MAX_ENTRIES", 128)
+HEADSWAP_CACHE_MAX_BYTES = _env_int("HEADSWAP_CACHE_MAX_BYTES", 128 * 1024 * 1024)
+HEADSWAP_CACHE_TTL = _env_float("HEADSWAP_CACHE_TTL", 24 * 60 * 60)  # seconds
+# Leave empty to keep the cache in memory only
+HEADSWAP_CACHE_DIR = _env_str("HEADSWAP_CACHE_DIR")
+HEADSWAP_CACHE_DISK_MAX_BYTES = _env_int("HEADSWAP_CACHE_DISK_MAX_BYTES", 1024 * 1024 * 1024)
+
+# Reference image data URI cache
+REFERENCE_CACHE_PRELOAD = _env_str("REFERENCE_CACHE_PRELOAD", "true").lower() == "true"
+REFERENCE_CACHE_REVALIDATE_INTERVAL = _env_float("REFERENCE_CACHE_REVALIDATE_INTERVAL", 5)  # seconds
+
+# Result store backing response_format=url on /api/swap-head
+RESULT_STORE_MAX_ENTRIES = _env_int("RESULT_STORE_MAX_ENTRIES", 128)
+RESULT_STORE_TTL = _env_float("RESULT_STORE_TTL", 10 * 60)  # seconds
+RESULT_STORE_MAX_BYTES = _env_int("RESULT_STORE_MAX_BYTES", 256 * 1024 * 1024)
+
+# Background try-on jobs (/api/tryon-jobs)
+TRYON_JOB_WORKERS = _env_int("TRYON_JOB_WORKERS", 4)
+TRYON_JOB_QUEUE_DEPTH = _env_int("TRYON_JOB_QUEUE_DEPTH", 32)
+TRYON_JOB_TTL = _env_float("TRYON_JOB_TTL", 10 * 60)  # seconds a finished job can be polled
+# Total size of finished results kept for polling (response_format=json inlines images)
+TRYON_JOB_MAX_BYTES = _env_int("TRYON_JOB_MAX_BYTES", 256 * 1024 * 1024)
+TRYON_JOB_RETRY_AFTER = _env_int("TRYON_JOB_RETRY_AFTER", 5)  # seconds, sent when the queue is full
+
+# HTTP caching for /images
+STATIC_CACHE_MAX_AGE = _env_int("STATIC_CACHE_MAX_AGE", 60 * 60)  # seconds
+# Per-directory overrides as directory=seconds pairs, e.g. "bodytypes=86400"
+STATIC_CACHE_DIRECTORY_MAX_AGES = _env_str("STATIC_CACHE_DIRECTORY_MAX_AGES", "bodytypes=86400")
+STATIC_INDEX_PRELOAD = _env_str("STATIC_INDEX_PRELOAD", "true").lower() == "true"
+# Let a fronting proxy send the file (X-Sendfile) instead of the Python worker
+STATIC_USE_X_SENDFILE = _env_str("STATIC_USE_X_SENDFILE", "false").lower() == "true"
+
+# Resized/re-encoded variants of /images (?width=&format=)
+IMAGE_DERIVATIVE_DIR = _env_str(
+    "IMAGE_DERIVATIVE_DIR", os.path.join(tempfile.gettempdir(), "tryon-image-derivatives")
+)
+IMAGE_DERIVATIVE_MAX_BYTES = _env_int("IMAGE_DERIVATIVE_MAX_BYTES", 256 * 1024 * 1024)
+IMAGE_DERIVATIVE_QUALITY = _env_int("IMAGE_DERIVATIVE_QUALITY", 80)
+
+# Admission control for /api/analyze-user-image and /api/swap-head; the
+# per-client rate comes from security_config.RATE_LIMIT_REQUESTS/WINDOW
+RATE_LIMIT_ENABLED = _env_str("RATE_LIMIT_ENABLED", "true").lower() == "true"
+# Number of trusted reverse proxies in front of the server. Clients are
+# identified by the X-Forwarded-For entry that many places from the right
+# (the address the outermost trusted proxy saw); entries further left are
+# set by the client and ignored. With 0 the peer address is used, so behind
+# a proxy every client shares one rate limit bucket: set this whenever the
+# server is not reached directly (e.g. bound to 127.0.0.1 behind nginx)
+ADMISSION_PROXY_HOPS = _env_int("ADMISSION_PROXY_HOPS", 0)
+# Request threads per gunicorn worker (gunicorn.conf.py). Requests waiting
+# for an admission slot hold a thread, so the cap and queue below default to
+# fractions of it, leaving threads free for /images, /results and job polling
+GUNICORN_THREADS = _env_int("GUNICORN_THREADS", 16)
+ADMISSION_MAX_CONCURRENT = _env_int("ADMISSION_MAX_CONCURRENT", max(1, GUNICORN_THREADS // 2))
+ADMISSION_MAX_WAITING = _env_int("ADMISSION_MAX_WAITING", GUNICORN_THREADS // 4)
+# In-flight cap for asgi.py, where waiting requests do not hold threads
+ASGI_MAX_CONCURRENT = _env_int("ASGI_MAX_CONCURRENT", 512)
+ADMISSION_WAIT_TIMEOUT = _env_float("ADMISSION_WAIT_TIMEOUT", 2)  # seconds
+ADMISSION_RETRY_AFTER = _env_int("ADMISSION_RETRY_AFTER", 2)  # seconds, sent with 503s
+
+# Adaptive OpenAI concurrency (openai_governor.py): starting and maximum
+# in-flight calls per budget; the limit adapts between 1 and the maximum
+OPENAI_CHAT_CONCURRENCY = _env_int("OPENAI_CHAT_CONCURRENCY", 8)
+OPENAI_CHAT_MAX_CONCURRENCY = _env_int("OPENAI_CHAT_MAX_CONCURRENCY", 32)
+OPENAI_IMAGE_CONCURRENCY = _env_int("OPENAI_IMAGE_CONCURRENCY", 2)
+OPENAI_IMAGE_MAX_CONCURRENCY = _env_int("OPENAI_IMAGE_MAX_CONCURRENCY", 8)
+# Seconds an analysis waits for a chat slot before the request fails with a 503
+OPENAI_ACQUIRE_TIMEOUT = _env_float("OPENAI_ACQUIRE_TIMEOUT", 20)
+# Attempts per OpenAI call; 429s, 5xx and connection errors are retried
+OPENAI_MAX_ATTEMPTS = _env_int("OPENAI_MAX_ATTEMPTS", 3)
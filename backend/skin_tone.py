@@ -0,0 +1,142 @@
+"""
+CPU skin-tone estimation from the Individual Typology Angle (ITA).
+
+ITA = arctan((L* - 50) / b*) in degrees, computed per pixel in CIELAB. Higher
+angles are lighter skin. The image is reduced to a small thumbnail, the
+centre region is kept (where the subject usually is), skin-coloured pixels
+are selected with a YCbCr box and the median ITA of those pixels is mapped
+to the same four buckets as SKIN_TONES in main.py.
+"""
+import math
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+# Lower ITA bound (degrees) of each bucket, lightest first. Based on the
+# Chardon ITA classes: very light/light, intermediate/tan, brown, dark
+ITA_BUCKETS = (
+    (41.0, "fair-light"),
+    (10.0, "olive"),
+    (-30.0, "brown"),
+    (-math.inf, "dark-brown"),
+)
+
+# Centre box (fractions of width and height) searched for skin pixels
+CENTER_BOX = (0.2, 0.05, 0.8, 0.75)
+
+# Chroma box commonly used to detect skin in YCbCr
+_CB_RANGE = (77, 127)
+_CR_RANGE = (133, 173)
+
+# sRGB (D65) to CIE XYZ
+_RGB_TO_XYZ = np.array(
+    [
+        [0.4124564, 0.3575761, 0.1804375],
+        [0.2126729, 0.7151522, 0.0721750],
+        [0.0193339, 0.1191920, 0.9503041],
+    ]
+)
+_WHITE_D65 = np.array([0.95047, 1.0, 1.08883])
+
+
+def ita_bucket(ita):
+    """
+    Map an ITA value in degrees to a skin tone bucket name.
+    """
+    for lower_bound, name in ITA_BUCKETS:
+        if ita >= lower_bound:
+            return name
+    return ITA_BUCKETS[-1][1]
+
+
+def _rgb_to_lab(rgb):
+    """
+    Convert an (N, 3) array of sRGB values in 0..255 to CIELAB.
+    """
+    srgb = rgb / 255.0
+    linear = np.where(srgb <= 0.04045, srgb / 12.92, ((srgb + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ _RGB_TO_XYZ.T / _WHITE_D65
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    lightness = 116 * f[:, 1] - 16
+    b = 200 * (f[:, 1] - f[:, 2])
+    return lightness, b
+
+
+def _skin_mask(rgb):
+    """
+    Select skin-coloured pixels of an (N, 3) RGB array by their YCbCr chroma.
+    """
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    cb = 128 - 0.168736 * r - 0.331264 * g + 0.5 * b
+    cr = 128 + 0.5 * r - 0.418688 * g - 0.081312 * b
+    return (
+        (cb >= _CB_RANGE[0])
+        & (cb <= _CB_RANGE[1])
+        & (cr >= _CR_RANGE[0])
+        & (cr <= _CR_RANGE[1])
+    )
+
+
+class SkinToneEstimator:
+    def __init__(self, max_edge=256, min_skin_fraction=0.03):
+        """
+        Args:
+            max_edge (int): Long edge the image is reduced to before analysis
+            min_skin_fraction (float): Share of the centre region that must be
+                skin for a full-confidence estimate
+        """
+        self.max_edge = max_edge
+        self.min_skin_fraction = min_skin_fraction
+
+    def estimate(self, image_bytes):
+        """
+        Estimate the skin tone of the person in the centre of an image.
+
+        Args:
+            image_bytes (bytes): Encoded image
+
+        Returns:
+            dict: skin_color (bucket name, None if no skin was found), ita
+            (median ITA in degrees), confidence (0-1) and skin_fraction
+        """
+        img = Image.open(BytesIO(image_bytes))
+        if img.format == "JPEG":
+            img.draft("RGB", (self.max_edge, self.max_edge))
+        img = img.convert("RGB")
+        img.thumbnail((self.max_edge, self.max_edge), Image.Resampling.BILINEAR)
+
+        width, height = img.size
+        left, top, right, bottom = CENTER_BOX
+        region = img.crop(
+            (int(width * left), int(height * top), int(width * right), int(height * bottom))
+        )
+        rgb = np.asarray(region, dtype=np.float64).reshape(-1, 3)
+        if rgb.size == 0:
+            return {"skin_color": None, "ita": None, "confidence": 0.0, "skin_fraction": 0.0}
+
+        skin = rgb[_skin_mask(rgb)]
+        skin_fraction = len(skin) / len(rgb)
+        if len(skin) == 0:
+            return {"skin_color": None, "ita": None, "confidence": 0.0, "skin_fraction": 0.0}
+
+        lightness, b = _rgb_to_lab(skin)
+        ita = np.degrees(np.arctan2(lightness - 50, b))
+        median_ita = float(np.median(ita))
+        skin_color = ita_bucket(median_ita)
+
+        # Agreement: share of skin pixels that fall in the chosen bucket,
+        # scaled down when only a few skin pixels were found
+        lower = next(bound for bound, name in ITA_BUCKETS if name == skin_color)
+        bounds = [bound for bound, _ in ITA_BUCKETS]
+        upper_index = bounds.index(lower) - 1
+        upper = bounds[upper_index] if upper_index >= 0 else math.inf
+        agreement = float(np.mean((ita >= lower) & (ita < upper)))
+        coverage = min(1.0, skin_fraction / self.min_skin_fraction)
+
+        return {
+            "skin_color": skin_color,
+            "ita": round(median_ita, 2),
+            "confidence": round(agreement * coverage, 3),
+            "skin_fraction": round(skin_fraction, 3),
+        }
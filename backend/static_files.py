@@ -0,0 +1,161 @@
+"""
+Metadata index for the files served under /images.
+
+Each file's size, modification time, MIME type and a strong ETag (SHA-256 of
+the content) are computed once and kept in memory, so conditional requests
+are answered with a 304 without reading the file. Cache lifetimes are chosen
+per directory, and content-hashed file names are served as immutable.
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import threading
+import time
+
+from werkzeug.security import safe_join
+
+# Names such as logo.3f2a9c1d.png change whenever their content does
+CONTENT_HASHED_NAME = re.compile(r"\.[0-9a-f]{8,}\.[A-Za-z0-9]+$")
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def parse_directory_max_ages(spec):
+    """
+    Parse per-directory cache lifetimes.
+
+    Args:
+        spec (str): Comma separated directory=seconds pairs, e.g.
+            "bodytypes=86400,products=604800"
+
+    Returns:
+        dict: Directory (relative, "/" separated) to max-age in seconds
+    """
+    max_ages = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        directory, _, seconds = item.partition("=")
+        max_ages[directory.strip().strip("/")] = int(seconds)
+    return max_ages
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StaticFileIndex:
+    def __init__(self, root, max_age=3600, directory_max_ages=None, revalidate_interval=5):
+        """
+        Args:
+            root (str): Directory served by the route
+            max_age (int): Cache lifetime in seconds for files not covered by
+                directory_max_ages
+            directory_max_ages (dict, optional): Relative directory to cache
+                lifetime; the longest matching directory wins
+            revalidate_interval (float): Minimum seconds between mtime/size
+                checks of an indexed file; 0 checks on every lookup
+        """
+        self.root = root
+        self.max_age = max_age
+        self.directory_max_ages = directory_max_ages or {}
+        self.revalidate_interval = revalidate_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def preload(self):
+        """
+        Index every file under the root directory.
+
+        Returns:
+            int: Number of files indexed
+        """
+        count = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                rel_path = os.path.relpath(os.path.join(dirpath, filename), self.root)
+                if self.lookup(rel_path.replace(os.sep, "/")) is not None:
+                    count += 1
+        logging.info(f"Indexed {count} static files under {self.root}")
+        return count
+
+    def cache_lifetime(self, filename):
+        """
+        Returns:
+            tuple: (max_age in seconds, immutable) for a path relative to the root
+        """
+        if CONTENT_HASHED_NAME.search(filename):
+            return IMMUTABLE_MAX_AGE, True
+        directory = os.path.dirname(filename)
+        while directory:
+            if directory in self.directory_max_ages:
+                return self.directory_max_ages[directory], False
+            directory = os.path.dirname(directory)
+        return self.max_age, False
+
+    def lookup(self, filename):
+        """
+        Get the metadata of a served file, indexing it on first use.
+
+        Args:
+            filename (str): Path relative to the root, as requested
+
+        Returns:
+            dict: path, size, mtime, etag, mimetype, max_age and immutable,
+            or None if the file does not exist or lies outside the root
+        """
+        now = time.monotonic()
+        entry = self._entries.get(filename)
+        if entry is not None:
+            if now - entry["checked_at"] < self.revalidate_interval:
+                self.hits += 1
+                return entry
+            try:
+                stat = os.stat(entry["path"])
+            except OSError:
+                with self._lock:
+                    self._entries.pop(filename, None)
+                return None
+            if (stat.st_mtime_ns, stat.st_size) == entry["signature"]:
+                entry["checked_at"] = now
+                self.hits += 1
+                return entry
+            self.reloads += 1
+        else:
+            self.misses += 1
+
+        path = safe_join(self.root, filename)
+        if path is None or not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        max_age, immutable = self.cache_lifetime(filename)
+        entry = {
+            "path": path,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "signature": (stat.st_mtime_ns, stat.st_size),
+            "etag": _file_sha256(path),
+            "mimetype": mimetypes.guess_type(path)[0] or "application/octet-stream",
+            "max_age": max_age,
+            "immutable": immutable,
+            "checked_at": now,
+        }
+        with self._lock:
+            self._entries[filename] = entry
+        return entry
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "reloads": self.reloads,
+        }
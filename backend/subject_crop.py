@@ -0,0 +1,197 @@
+"""
+Optional CPU cropping of uploads to the person in them.
+
+Most of an upload is background. A face is located with the Haar cascade
+bundled with OpenCV on a small grayscale copy of the image, and the upload is
+cropped around it before it is sent upstream:
+
+    person - full-person box for the analysis: a few face widths either side,
+             from just above the head to the bottom of the frame, so the
+             body type can still be judged
+    head   - head-and-shoulders box for the HeadSwapper, which only takes
+             the head from the user image
+
+When OpenCV is not installed, no face is found or the crop would barely
+shrink the image, the full frame is used as before.
+
+OpenCV is optional: pip install "opencv-python-headless<5" (OpenCV 5 moved
+the Haar cascades out of the main package)
+"""
+import logging
+import threading
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageOps
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# Margins around the detected face, in face widths (left/right) and face
+# heights (above/below); None below means down to the bottom of the frame
+CROP_MARGINS = {
+    "person": {"side": 2.5, "above": 0.8, "below": None},
+    "head": {"side": 1.0, "above": 0.8, "below": 1.5},
+}
+
+
+class SubjectCropper:
+    def __init__(self, detect_edge=640, min_face=0.05, max_area=0.85, quality=95):
+        """
+        Args:
+            detect_edge (int): Long edge of the grayscale copy searched for faces
+            min_face (float): Smallest face searched for, as a fraction of the
+                short edge
+            max_area (float): Crops keeping more than this share of the frame
+                are skipped as not worth a re-encode
+            quality (int): JPEG quality of the cropped image
+        """
+        self.detect_edge = detect_edge
+        self.min_face = min_face
+        self.max_area = max_area
+        self.quality = quality
+        self._detector = None
+        if cv2 is not None and hasattr(cv2, "CascadeClassifier"):
+            self._detector = cv2.CascadeClassifier(
+                cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+            )
+        else:
+            logging.warning("OpenCV 4 is not installed; subject cropping uses the full frame")
+        # CascadeClassifier is not safe to share between threads
+        self._detector_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self.images = 0
+        self.cropped = 0
+        self.no_face = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    @property
+    def available(self):
+        return self._detector is not None and not self._detector.empty()
+
+    def find_face(self, img):
+        """
+        Find the most prominent face: large and close to the centre.
+
+        Args:
+            img (PIL.Image.Image): Upright image
+
+        Returns:
+            tuple: (left, top, width, height) in img coordinates, or None
+        """
+        scale = min(1.0, self.detect_edge / max(img.size))
+        small = img.convert("L")
+        if scale < 1.0:
+            small = small.resize(
+                (round(img.width * scale), round(img.height * scale)), Image.Resampling.BILINEAR
+            )
+        gray = cv2.equalizeHist(np.asarray(small))
+        min_size = max(16, int(min(gray.shape) * self.min_face))
+        with self._detector_lock:
+            faces = self._detector.detectMultiScale(
+                gray, scaleFactor=1.1, minNeighbors=5, minSize=(min_size, min_size)
+            )
+        if len(faces) == 0:
+            return None
+
+        height, width = gray.shape
+
+        def prominence(face):
+            x, y, w, h = face
+            offset = abs((x + w / 2) / width - 0.5) + abs((y + h / 2) / height - 0.4)
+            return w * h * (1.0 - offset)
+
+        x, y, w, h = max(faces, key=prominence)
+        return tuple(int(round(v / scale)) for v in (x, y, w, h))
+
+    def crop_box(self, face, size, kind):
+        """
+        Expand a face box to the crop for kind ("person" or "head").
+
+        Returns:
+            tuple: (left, top, right, bottom) clamped to the image
+        """
+        x, y, w, h = face
+        width, height = size
+        margins = CROP_MARGINS[kind]
+        bottom = height if margins["below"] is None else y + h + h * margins["below"]
+        return (
+            max(0, int(x - w * margins["side"])),
+            max(0, int(y - h * margins["above"])),
+            min(width, int(x + w + w * margins["side"])),
+            min(height, int(bottom)),
+        )
+
+    def crop(self, image_bytes, kind):
+        """
+        Crop an upload to the person in it.
+
+        Args:
+            image_bytes (bytes): Encoded image
+            kind (str): "person" or "head", see CROP_MARGINS
+
+        Returns:
+            bytes: The cropped image as JPEG, or image_bytes unchanged when
+            no useful crop was found
+        """
+        if not self.available:
+            return image_bytes
+        start = time.perf_counter()
+        output = image_bytes
+        face = None
+        try:
+            img = Image.open(BytesIO(image_bytes))
+            icc_profile = img.info.get("icc_profile")
+            img = ImageOps.exif_transpose(img)
+            face = self.find_face(img)
+            if face is not None:
+                box = self.crop_box(face, img.size, kind)
+                area = (box[2] - box[0]) * (box[3] - box[1])
+                if area < self.max_area * img.width * img.height:
+                    region = img.crop(box)
+                    if img.mode != "RGB":
+                        # The embedded profile describes the original mode
+                        icc_profile = None
+                    if region.mode in ("RGBA", "LA", "P"):
+                        flattened = Image.new("RGB", region.size, (255, 255, 255))
+                        flattened.paste(region.convert("RGBA"), mask=region.convert("RGBA"))
+                        region = flattened
+                    elif region.mode != "RGB":
+                        region = region.convert("RGB")
+                    buffered = BytesIO()
+                    region.save(
+                        buffered, format="JPEG", quality=self.quality, icc_profile=icc_profile
+                    )
+                    if buffered.tell() < len(image_bytes):
+                        output = buffered.getvalue()
+        except Exception as e:
+            logging.debug(f"DEBUG: Subject crop failed, using the full frame: {e}")
+            output = image_bytes
+
+        with self._lock:
+            self.images += 1
+            self.cropped += output is not image_bytes
+            self.no_face += face is None
+            self.bytes_in += len(image_bytes)
+            self.bytes_out += len(output)
+            self.seconds += time.perf_counter() - start
+        logging.debug(
+            f"DEBUG: Subject crop ({kind}): face={face}, {len(image_bytes)} -> {len(output)} bytes"
+        )
+        return output
+
+    def stats(self):
+        return {
+            "available": self.available,
+            "images": self.images,
+            "cropped": self.cropped,
+            "no_face": self.no_face,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "avg_ms": self.seconds / self.images * 1000 if self.images else 0.0,
+        }
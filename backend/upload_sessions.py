@@ -0,0 +1,62 @@
+"""
+Short-lived upload sessions.
+
+The analyze endpoint registers each upload here and hands the client an opaque
+handle, so later try-ons can reuse the normalized image bytes and analysis
+without a second upload or a second analysis call.
+"""
+import secrets
+
+from caching import TTLCache
+
+
+class UploadSessionStore:
+    def __init__(self, max_entries=128, ttl=900, max_bytes=None):
+        """
+        Args:
+            max_entries (int): Maximum number of live sessions
+            ttl (float): Seconds a session stays valid after creation
+            max_bytes (int, optional): Total image bytes kept before the least
+                recently used sessions are dropped, None for no limit
+        """
+        self.ttl = ttl
+        self._sessions = TTLCache(
+            max_entries=max_entries,
+            ttl=ttl,
+            max_bytes=max_bytes,
+            size=lambda session: len(session["image_bytes"]),
+        )
+
+    def create(self, image_bytes, analysis, image_hash=None):
+        """
+        Register an upload and its analysis.
+
+        Args:
+            image_bytes (bytes): Normalized image bytes to reuse for later try-ons
+            analysis (dict): Parsed analysis for the image
+            image_hash (str, optional): Content hash of the original upload
+
+        Returns:
+            str: Opaque upload handle
+        """
+        handle = secrets.token_urlsafe(24)
+        self._sessions.set(
+            handle,
+            {"image_bytes": image_bytes, "analysis": analysis, "image_hash": image_hash},
+        )
+        return handle
+
+    def get(self, handle):
+        """
+        Look up a session by handle.
+
+        Returns:
+            dict: Session with image_bytes, analysis and image_hash keys, or
+            None if the handle is unknown or expired
+        """
+        if not handle:
+            return None
+        return self._sessions.get(handle)
+
+    def stats(self):
+        return self._sessions.stats()
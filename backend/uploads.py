@@ -0,0 +1,118 @@
+"""
+Streaming ingestion of uploaded images.
+
+Multipart file parts are written into an UploadStream instead of Werkzeug's
+default container (which spools anything over 500KB to a temporary file).
+The stream hashes and sniffs the content as it arrives and rejects the
+request as soon as the size limit is crossed.
+"""
+import hashlib
+import time
+from io import BytesIO
+
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from security_config import MAX_FILE_SIZE
+
+# Extra room for multipart boundaries and small form fields on top of the file
+FORM_OVERHEAD_BYTES = 64 * 1024
+MAX_CONTENT_LENGTH = MAX_FILE_SIZE + FORM_OVERHEAD_BYTES
+
+_SNIFF_BYTES = 12
+
+
+def sniff_image_type(header):
+    """
+    Identify an image format from its leading bytes.
+
+    Args:
+        header (bytes): At least the first 12 bytes of the file
+
+    Returns:
+        str: MIME type, or None if the bytes are not a supported image
+    """
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if header.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if header.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if header.startswith(b"BM"):
+        return "image/bmp"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+class UploadStream(BytesIO):
+    """
+    In-memory container for one uploaded file that hashes and sniffs the
+    content while it is written and enforces the size limit.
+    """
+
+    def __init__(self, max_bytes=MAX_FILE_SIZE):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.rejected = False
+        self._header = b""
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise RequestEntityTooLarge()
+        if self.rejected:
+            # Not an image: keep counting but stop buffering
+            return len(data)
+        if len(self._header) < _SNIFF_BYTES:
+            self._header += bytes(data[: _SNIFF_BYTES - len(self._header)])
+            if len(self._header) == _SNIFF_BYTES and sniff_image_type(self._header) is None:
+                self.rejected = True
+                self.seek(0)
+                self.truncate()
+                return len(data)
+        self._sha256.update(data)
+        return super().write(data)
+
+    @property
+    def image_type(self):
+        """MIME type sniffed from the content, None if it is not an image."""
+        if self.rejected:
+            return None
+        return sniff_image_type(self._header)
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest()
+
+
+def upload_stream_factory(total_content_length, content_type, filename=None, content_length=None):
+    """
+    Stream factory for the Werkzeug and Quart multipart parsers.
+    """
+    if content_length and content_length > MAX_FILE_SIZE:
+        raise RequestEntityTooLarge()
+    return UploadStream()
+
+
+class UploadRequest(Request):
+    """
+    Flask request that keeps file uploads in an UploadStream.
+    """
+
+    upload_read_seconds = None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return upload_stream_factory(total_content_length, content_type, filename, content_length)
+
+    def _load_form_data(self):
+        if "form" in self.__dict__:
+            return
+        start = time.perf_counter()
+        super()._load_form_data()
+        if self.mimetype == "multipart/form-data":
+            # Time spent receiving and parsing the upload, for the metrics
+            self.upload_read_seconds = time.perf_counter() - start
+
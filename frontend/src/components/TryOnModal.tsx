@@ -61,14 +61,6 @@ export function TryOnModal({ isOpen, onClose, selectedColor }: TryOnModalProps)
     setIsDiffusing(true);
     setApiResult(null);
     try {
-      // Step 1: Analyze
-      const analysisResult = await ApiService.analyzeUserImage(uploadedFile!);
-      setAnalysis(analysisResult);
-      // Step 2: Headswap
-      const referenceImagePath = `bodytypes/headswapper/${analysisResult.metadata.body_type}/jordan_red_hoodie_reference_${analysisResult.metadata.skin_color}.png`;
-      setReferenceImageUrl(`/images/${referenceImagePath}`);
-      console.debug('[TryOnModal] Animation started with reference image:', `/images/${referenceImagePath}`);
-      // Start reveal animation up to maxReveal
       let start = Date.now();
       let animationFrame: number;
       let finished = false;
@@ -102,22 +94,29 @@ export function TryOnModal({ isOpen, onClose, selectedColor }: TryOnModalProps)
           }
         }
       };
-      animationFrame = requestAnimationFrame(animate);
-      // Start API call in parallel
-      ApiService.swapHead(uploadedFile!, referenceImagePath).then((apiResult) => {
-        result = apiResult;
-        setApiResult(apiResult);
-        apiDone = true;
-        if (!revealDone) {
-          // If reveal is not done, finish it instantly
-          setRevealProgress(1);
-          revealDone = true;
-        }
-        if (revealDone) {
-          finished = true;
-          finish();
-        }
+      // Analysis and head swap run as one streamed request; the reveal
+      // animation starts as soon as the backend has picked the reference image
+      const apiResult = await ApiService.swapHeadStream(uploadedFile!, {
+        onAnalysis: (analysisResult) => setAnalysis(analysisResult),
+        onPregenerated: (pregeneratedImageUrl) => {
+          setReferenceImageUrl(pregeneratedImageUrl);
+          console.debug('[TryOnModal] Animation started with reference image:', pregeneratedImageUrl);
+          start = Date.now();
+          animationFrame = requestAnimationFrame(animate);
+        },
       });
+      result = apiResult;
+      setApiResult(apiResult);
+      apiDone = true;
+      if (!revealDone) {
+        // If reveal is not done, finish it instantly
+        setRevealProgress(1);
+        revealDone = true;
+      }
+      if (revealDone) {
+        finished = true;
+        finish();
+      }
     } catch (err) {
       setIsLoading(false);
       setIsDiffusing(false);
@@ -10,15 +10,25 @@ export interface AnalysisResult {
   };
   success: boolean;
   message: string;
+  // Handle that lets swapHead reuse this upload and analysis
+  upload_id?: string;
+  upload_expires_in?: number;
 }
 
 export interface HeadSwapResult {
   output_image: string;
+  // Set instead of an inline output_image when response_format is 'url'
+  output_image_url?: string;
   analysis: AnalysisResult;
   pregenerated_image_url: string;
   warning?: string;
 }
 
+export interface SwapHeadStreamHandlers {
+  onAnalysis?: (analysis: AnalysisResult) => void;
+  onPregenerated?: (pregeneratedImageUrl: string) => void;
+}
+
 export class ApiService {
   private static baseUrl = process.env.NEXT_PUBLIC_API_URL || 'http://127.0.0.1:5003';
 
@@ -67,7 +77,7 @@ export class ApiService {
     }
   }
 
-  static async swapHead(file: File, referenceImagePath: string): Promise<HeadSwapResult> {
+  static async swapHead(file: File, referenceImagePath: string, uploadId?: string): Promise<HeadSwapResult> {
     const formData = new FormData();
     
     // Ensure the file has a proper name with extension
@@ -78,10 +88,17 @@ export class ApiService {
       fileName = `uploaded_image.${extension}`;
     }
     
-    // Create a new File object with the proper name
-    const fileWithName = new File([file], fileName, { type: file.type });
-    formData.append('image', fileWithName);
+    if (uploadId) {
+      // Reuse the upload from analyzeUserImage instead of sending the file again
+      formData.append('upload_id', uploadId);
+    } else {
+      // Create a new File object with the proper name
+      const fileWithName = new File([file], fileName, { type: file.type });
+      formData.append('image', fileWithName);
+    }
     formData.append('reference_image', referenceImagePath);
+    // Fetch the output image by URL instead of inlining it as base64 JSON
+    formData.append('response_format', 'url');
 
     console.log('Sending swap-head request to:', `${this.baseUrl}/api/swap-head`);
     console.log('File size:', file.size, 'bytes');
@@ -95,6 +112,11 @@ export class ApiService {
         body: formData,
       });
 
+      if (response.status === 410 && uploadId) {
+        // The upload session expired on the server, send the file itself
+        return this.swapHead(file, referenceImagePath);
+      }
+
       console.log('Swap-head response status:', response.status);
       console.log('Swap-head response headers:', Object.fromEntries(response.headers.entries()));
 
@@ -104,7 +126,11 @@ export class ApiService {
         throw new Error(`Head swap failed: ${response.statusText} - ${errorData.error || ''}`);
       }
 
-      const result = await response.json();
+      const result: HeadSwapResult = await response.json();
+      if (result.output_image_url && !result.output_image) {
+        const url = result.output_image_url;
+        result.output_image = url.startsWith('/') ? `${this.baseUrl}${url}` : url;
+      }
       console.log('Swap-head result:', result);
       return result;
     } catch (error) {
@@ -112,4 +138,81 @@ export class ApiService {
       throw new Error('Failed to process try-on. Please try again.');
     }
   }
+
+  // Runs analysis and head swap in one request, reporting each stage as the
+  // backend finishes it (Server-Sent Events over a POST response)
+  static async swapHeadStream(file: File, handlers: SwapHeadStreamHandlers = {}): Promise<HeadSwapResult> {
+    const formData = new FormData();
+
+    // Ensure the file has a proper name with extension
+    let fileName = file.name;
+    if (!fileName || !fileName.includes('.')) {
+      // If no filename or no extension, create one based on MIME type
+      const extension = file.type.split('/')[1] || 'jpg';
+      fileName = `uploaded_image.${extension}`;
+    }
+
+    const fileWithName = new File([file], fileName, { type: file.type });
+    formData.append('image', fileWithName);
+    formData.append('response_format', 'url');
+
+    console.log('Sending swap-head stream request to:', `${this.baseUrl}/api/swap-head/stream`);
+
+    try {
+      const response = await fetch(`${this.baseUrl}/api/swap-head/stream`, {
+        method: 'POST',
+        body: formData,
+      });
+
+      if (!response.ok || !response.body) {
+        const errorData = await response.json().catch(() => ({}));
+        console.error('Swap-head stream error response:', errorData);
+        throw new Error(`Head swap failed: ${response.statusText} - ${errorData.error || ''}`);
+      }
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      for (;;) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+          const message = buffer.slice(0, boundary);
+          buffer = buffer.slice(boundary + 2);
+
+          let event = 'message';
+          let data = '';
+          for (const line of message.split('\n')) {
+            if (line.startsWith('event: ')) event = line.slice(7);
+            else if (line.startsWith('data: ')) data += line.slice(6);
+          }
+          const payload = data ? JSON.parse(data) : {};
+          console.log('Swap-head stream event:', event);
+
+          if (event === 'analysis') {
+            handlers.onAnalysis?.(payload);
+          } else if (event === 'pregenerated') {
+            handlers.onPregenerated?.(payload.pregenerated_image_url);
+          } else if (event === 'error') {
+            throw new Error(`Head swap failed: ${payload.error || ''}`);
+          } else if (event === 'result') {
+            const result: HeadSwapResult = payload;
+            if (result.output_image_url && !result.output_image) {
+              const url = result.output_image_url;
+              result.output_image = url.startsWith('/') ? `${this.baseUrl}${url}` : url;
+            }
+            await reader.cancel();
+            return result;
+          }
+        }
+      }
+      throw new Error('Head swap stream ended without a result');
+    } catch (error) {
+      console.error('Head swap stream error:', error);
+      throw new Error('Failed to process try-on. Please try again.');
+    }
+  }
 } 
\ No newline at end of file